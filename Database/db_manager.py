@@ -32,6 +32,24 @@ def get_connection(db_name):
     return conn
 
 
+def get_persistent_connection(db_name):
+    """
+    Funzione per aprire una connessione al database da mantenere aperta e riutilizzare tra più operazioni
+    - Creazione della connessione al database specificato, utilizzabile anche da thread diversi
+      da quello che l'ha creata (Streamlit esegue ogni rerun in un thread diverso)
+    - Abilita i vincoli di integrità referenziale (foreign key)
+    - Abilita il journal WAL e la sincronizzazione NORMAL, per commit più rapidi e letture
+      non bloccate dalle scritture
+    :param db_name: nome del database
+    :return: connessione al database
+    """
+    conn = sqlite3.connect(db_name, check_same_thread=False)
+    conn.execute("PRAGMA foreign_keys = ON")
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    return conn
+
+
 def insert_data(db_name, table_name, data_dict):
     """
     Funzione per inserire dati all'interno del database
@@ -63,6 +81,59 @@ def insert_data(db_name, table_name, data_dict):
         conn.close()
 
 
+def insert_with_children(db_name, table_name, data_dict, child_table_name, child_rows, foreign_key, conn=None):
+    """
+    Funzione per inserire una riga e le righe collegate di un'altra tabella in un'unica transazione
+    - Connessione al database (oppure utilizzo della connessione già aperta passata come parametro)
+    - Costruzione dinamica delle query SQL INSERT in base alle chiavi dei dizionari
+    - Utilizzo di segnaposto (?) per prevenire SQL injection
+    - Inserisce la riga principale e ne recupera l'ID dal cursore (lastrowid)
+    - Inserisce con executemany tutte le righe collegate, assegnando l'ID alla colonna foreign_key
+    - Entrambi gli inserimenti fanno parte della stessa transazione: se uno dei due fallisce (ad esempio
+      per un vincolo CHECK su una riga collegata) vengono annullati entrambi, così che nel database non
+      resti una riga principale senza le righe collegate
+    - Chiusura della connessione (solo se aperta dalla funzione)
+    :param db_name: nome del database
+    :param table_name: nome della tabella dove inserire la riga principale
+    :param data_dict: dizionario con i dati della riga principale, con chiavi come nomi delle colonne
+    :param child_table_name: nome della tabella dove inserire le righe collegate
+    :param child_rows: lista di dizionari con i dati delle righe collegate, tutti con le stesse chiavi
+                       (senza la colonna foreign_key)
+    :param foreign_key: nome della colonna delle righe collegate che contiene l'ID della riga principale
+    :param conn: connessione già aperta da utilizzare. Se None, viene aperta una nuova connessione
+    :return: "inserted" se l'inserimento è riuscito, "exists" se la riga principale viola un vincolo
+             (ad esempio di unicità), "error: ..." se una riga collegata non può essere inserita
+    """
+    columns = ', '.join(data_dict.keys())
+    placeholders = ', '.join(['?'] * len(data_dict))
+    query = f"INSERT INTO {table_name} ({columns}) VALUES ({placeholders})"
+
+    child_columns = [foreign_key] + [col for col in (child_rows[0].keys() if child_rows else []) if col != foreign_key]
+    child_query = (f"INSERT INTO {child_table_name} ({', '.join(child_columns)}) "
+                   f"VALUES ({', '.join(['?'] * len(child_columns))})")
+
+    own_conn = conn is None
+    if own_conn:
+        conn = get_connection(db_name)
+    try:
+        with conn:
+            try:
+                parent_id = conn.execute(query, tuple(data_dict.values())).lastrowid
+            except sqlite3.IntegrityError:
+                conn.rollback()
+                return "exists"
+            if child_rows:
+                conn.executemany(child_query, [
+                    (parent_id,) + tuple(row[col] for col in child_columns[1:]) for row in child_rows
+                ])
+        return "inserted"
+    except sqlite3.Error as e:
+        return f"error: {e}"
+    finally:
+        if own_conn:
+            conn.close()
+
+
 def read_data(db_name, table_name):
     """
     Funzione per leggere dati all'interno del database
@@ -106,12 +177,13 @@ def delete_data(db_name, table_name, conditions):
     conn.close()
 
 
-def get_data(db_name, table_name, columns, conditions=None):
+def get_data(db_name, table_name, columns, conditions=None, limit=None):
     """
     Funzione per leggere dati specifici da una tabella con condizioni facoltative
     - Connessione al database
     - Creazione di un cursore per eseguire le query
-    - Costruzione dinamica della query con colonne selezionate e condizioni WHERE opzionali
+    - Costruzione dinamica della query con colonne selezionate, condizioni WHERE opzionali e
+      clausola LIMIT opzionale
     - Esecuzione sicura della query con parametri ? per prevenire SQL injection
     - Recupero delle righe
     - Chiusura della connessione
@@ -119,6 +191,7 @@ def get_data(db_name, table_name, columns, conditions=None):
     :param table_name: nome della tabella
     :param columns: lista o stringa di colonne da leggere (es: ["id", "name"] o "id")
     :param conditions: dizionario di condizioni per la clausola WHERE. Se None, non viene applicato alcun filtro
+    :param limit: numero massimo di righe da restituire. Se None, restituisce tutte le righe
     :return: righe selezionate della tabella (lista di tuple)
     """
     if isinstance(columns, str):
@@ -128,14 +201,16 @@ def get_data(db_name, table_name, columns, conditions=None):
     conn = get_connection(db_name)
     c = conn.cursor()
 
+    query = f"SELECT {columns_str} FROM {table_name}"
+    values = ()
     if conditions:
         where_clause = ' AND '.join([f"{col} = ?" for col in conditions.keys()])
         values = tuple(conditions.values())
-        query = f"SELECT {columns_str} FROM {table_name} WHERE {where_clause}"
-        c.execute(query, values)
-    else:
-        query = f"SELECT {columns_str} FROM {table_name}"
-        c.execute(query)
+        query += f" WHERE {where_clause}"
+    if limit is not None:
+        query += " LIMIT ?"
+        values += (limit,)
+    c.execute(query, values)
 
     rows = c.fetchall()
     conn.close()
@@ -1,10 +1,9 @@
 import streamlit as st
 import pandas as pd
 import os
-import time
 
 from Database.db_manager import insert_data, delete_data, get_data
-from Modules.ocr_groq import delete_json_from_folder
+from Modules.ocr_groq import delete_json_from_folder, delete_ocr_cache_entry
 
 
 IMAGE_DIR = "Images"
@@ -84,7 +83,7 @@ def process_uploaded_file(uploaded_files):
     - Mostra un'anteprima dinamica (tipo galleria) delle immagini caricate, ma non ancora salvate
     - Imposta un flag per evitare che la preview venga ripetuta dopo il salvataggio
     - Crea un bottone per salvare i file nel database e nella cartella 'Images'
-    - Durante il salvataggio, visualizza una barra di avanzamento
+    - Durante il salvataggio, visualizza una barra di avanzamento aggiornata a ogni file elaborato
     - Se un file è già presente nella cartella o nel database, non lo salva di nuovo e mostra un avviso
     - Se invece non sono presenti file da caricare, mostra un warning che invita a fare l'upload per procedere
     :param uploaded_files: lista di file di cui fare l'upload (può essere anche solo uno)
@@ -111,16 +110,15 @@ def process_uploaded_file(uploaded_files):
                 st.session_state.files_saved = True  # Dopo il salvataggio, blocca le preview
 
                 with st.spinner("Saving files..."):
+                    files_to_save = st.session_state.uploaded_files_for_preview
                     progress = st.progress(0)
-                    for i in range(100):
-                        time.sleep(0.01)
-                        progress.progress(i + 1)
 
                     saved_count = 0
                     skipped_files_folder = set()
                     skipped_files_db = set()
 
-                    for uploaded_file in st.session_state.uploaded_files_for_preview:
+                    for i, uploaded_file in enumerate(files_to_save, start=1):
+                        progress.progress(i / len(files_to_save))
                         file_path, already_exists = save_image_to_folder(uploaded_file)
                         if already_exists:
                             skipped_files_folder.add(uploaded_file.name)
@@ -204,6 +202,7 @@ def delete_file_from_database_and_folder(data):
     - Seleziona il file immagine da poter eliminare tra quelli presenti nel database
     - Crea un bottone per eliminare il file immagine
     - Prima della cancellazione chiede conferma, solo in caso affermativo procede a cancellare il file immagine
+    - Elimina anche la risposta OCR in cache, così che caricando di nuovo lo stesso file l'OCR venga rieseguito
     :param: data: dati presenti nel database
     """
     if data:
@@ -217,6 +216,9 @@ def delete_file_from_database_and_folder(data):
                 delete_data("documents.db", "receipts", {"File_path": file_to_delete})
                 st.success(f"File '{file_to_delete}' successfully deleted from database!")
 
+                # La risposta OCR in cache va eliminata prima dell'immagine, da cui dipende la chiave
+                delete_ocr_cache_entry(os.path.join(IMAGE_DIR, file_to_delete))
+
                 deleted_from_folder = delete_image_from_folder(file_to_delete)
                 if deleted_from_folder:
                     st.success(f"Image '{file_to_delete}' successfully deleted from the folder!")
@@ -0,0 +1,37 @@
+import os
+import tomllib
+from functools import lru_cache
+
+
+# Stesso file di secrets usato dall'interfaccia Streamlit, letto senza importare Streamlit
+SECRETS_FILE = os.path.join(".streamlit", "secrets.toml")
+
+
+@lru_cache(maxsize=1)
+def load_secrets():
+    """
+    Funzione per leggere il file dei secrets condiviso con l'interfaccia Streamlit
+    - Legge il file TOML con tomllib della libreria standard, una sola volta per processo
+    - Se il file non esiste, restituisce un dizionario vuoto
+    :return: dizionario {sezione: {chiave: valore}}
+    """
+    try:
+        with open(SECRETS_FILE, "rb") as f:
+            return tomllib.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def get_secret(section, key):
+    """
+    Funzione per ottenere il valore di un secret
+    - Usa la variabile d'ambiente con lo stesso nome della chiave, se impostata
+    - Altrimenti cerca la chiave nella sezione indicata del file dei secrets
+    :param section: sezione del file dei secrets (ad esempio "general")
+    :param key: nome della chiave
+    :return: valore del secret
+    """
+    value = os.environ.get(key) or load_secrets().get(section, {}).get(key)
+    if value is None:
+        raise KeyError(f"Secret '{key}' non trovato né tra le variabili d'ambiente né in {SECRETS_FILE}")
+    return value
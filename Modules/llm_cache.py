@@ -0,0 +1,127 @@
+import hashlib
+import os
+import threading
+import orjson
+
+
+LLM_CACHE_DIR = "LLM_Cache"
+LLM_CACHE_FILE = os.path.join(LLM_CACHE_DIR, "llm_cache.json")
+LLM_CACHE_MAX_ENTRIES = 512  # numero massimo di risposte memorizzate, oltre il quale si eliminano le meno usate
+
+# Contatori di utilizzo della cache, condivisi da tutte le sessioni del processo
+cache_stats = {"hits": 0, "misses": 0}
+
+cached_responses = None
+cache_lock = threading.Lock()
+
+
+def build_cache_key(*parts):
+    """
+    Funzione per costruire la chiave di cache di una chiamata al modello AI
+    - Concatena tutte le parti che determinano la risposta (immagine, prompt, testo, modello...),
+      convertendo le stringhe in bytes e separandole con un carattere nullo per evitare ambiguità
+    - Calcola l'hash SHA-256 del risultato
+    :param parts: parti della richiesta, come stringhe o bytes
+    :return: stringa esadecimale dell'hash da usare come chiave
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def read_json_file(path, default):
+    """
+    Funzione per leggere un file JSON salvato in LLM_CACHE_DIR
+    - Se il file non esiste o non è valido, restituisce il valore di default
+    :param path: percorso del file
+    :param default: valore da restituire se il file non può essere letto
+    :return: contenuto del file oppure default
+    """
+    try:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return default
+
+
+def write_json_file(path, data):
+    """
+    Funzione per salvare dati in un file JSON in LLM_CACHE_DIR
+    - Scrive su un file temporaneo e lo sostituisce a quello esistente, così che un'interruzione
+      durante la scrittura non lasci un file incompleto
+    - I valori non serializzabili in JSON (ad esempio date) vengono salvati come stringhe
+    :param path: percorso del file
+    :param data: dati da salvare
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(data, default=str))
+    os.replace(tmp_path, path)
+
+
+def load_cache():
+    """
+    Funzione per caricare in memoria la cache delle risposte salvata su disco
+    - Legge il file JSON della cache solo alla prima chiamata, poi riutilizza il dizionario in memoria
+    - Se il file non esiste o non è valido, parte da una cache vuota
+    :return: dizionario {chiave: risposta}
+    """
+    global cached_responses
+    if cached_responses is None:
+        cached_responses = read_json_file(LLM_CACHE_FILE, {})
+    return cached_responses
+
+
+def get_cached_response(key):
+    """
+    Funzione per recuperare dalla cache la risposta di una chiamata al modello AI
+    - Aggiorna i contatori di hit e miss della cache
+    - Segna la risposta come usata più di recente, così che sia l'ultima a essere eliminata
+    :param key: chiave della richiesta, costruita con build_cache_key
+    :return: risposta salvata oppure None se la richiesta non è in cache
+    """
+    with cache_lock:
+        cache = load_cache()
+        response = cache.pop(key, None)
+        if response is not None:
+            # Reinserisce la risposta in fondo al dizionario, che è ordinato dalla meno alla più usata
+            cache[key] = response
+        cache_stats["hits" if response is not None else "misses"] += 1
+    return response
+
+
+def save_cached_response(key, response):
+    """
+    Funzione per salvare in cache la risposta di una chiamata al modello AI
+    - Aggiunge la risposta al dizionario in memoria
+    - Se la cache supera LLM_CACHE_MAX_ENTRIES risposte, elimina quelle usate meno di recente, così che
+      il file (riscritto per intero a ogni salvataggio) non cresca senza limiti
+    - Riscrive il file JSON della cache con write_json_file
+    :param key: chiave della richiesta, costruita con build_cache_key
+    :param response: testo della risposta del modello da salvare
+    """
+    with cache_lock:
+        cache = load_cache()
+        cache.pop(key, None)
+        cache[key] = response
+        while len(cache) > LLM_CACHE_MAX_ENTRIES:
+            del cache[next(iter(cache))]
+        write_json_file(LLM_CACHE_FILE, cache)
+
+
+def delete_cached_response(key):
+    """
+    Funzione per eliminare dalla cache la risposta di una chiamata al modello AI
+    - Se la risposta è presente, la rimuove dal dizionario in memoria e riscrive il file JSON della cache
+    :param key: chiave della richiesta, costruita con build_cache_key
+    :return: True se la risposta è stata eliminata, False se non era in cache
+    """
+    with cache_lock:
+        cache = load_cache()
+        if cache.pop(key, None) is None:
+            return False
+        write_json_file(LLM_CACHE_FILE, cache)
+    return True
@@ -1,7 +1,17 @@
-import streamlit as st
-
+import atexit
+import hashlib
+import logging
+import os
+import threading
+import orjson
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, text
 from langchain_openai import ChatOpenAI
 from langchain_community.utilities import SQLDatabase
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import get_buffer_string
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain.chains import create_sql_query_chain
@@ -9,7 +19,69 @@ from langchain.tools import Tool
 from langchain.agents import initialize_agent
 from langchain.agents.agent_types import AgentType
 
-from Modules.ocr_groq import load_prompt
+from Modules.prompts import load_prompt
+from Modules.llm_cache import LLM_CACHE_DIR, read_json_file, write_json_file
+
+
+QUESTION_VALIDITY_CACHE_SIZE = 1024  # numero massimo di esiti di validazione memorizzati
+QUESTION_VALIDITY_CACHE_FILE = os.path.join(LLM_CACHE_DIR, "question_validity_cache.json")
+PROMPT_PREFIX_BYTES = 2048  # parte iniziale del prompt di cui viene registrato l'hash
+
+logger = logging.getLogger(__name__)
+
+# Lista in cui il tool QueryExecutor aggiunge colonne e righe di ogni esecuzione (None in caso di errore), impostata
+# dal chiamante prima di eseguire l'agente per leggere il risultato senza riconvertire il testo restituito
+query_results = ContextVar("query_results", default=None)
+
+# Tag della chiamata al modello che genera la risposta finale, usato dal chiamante per mostrare in streaming solo
+# i token di questa risposta e non quelli dei ragionamenti intermedi dell'agente
+FINAL_ANSWER_TAG = "final_answer"
+
+# Esiti della validazione delle domande {domanda, hash dello schema e modello: True/False}, dal meno al più recente;
+# vengono ripresi dal file salvato alla chiusura del processo precedente, se presente
+question_validity_cache = OrderedDict(
+    list(read_json_file(QUESTION_VALIDITY_CACHE_FILE, {}).items())[-QUESTION_VALIDITY_CACHE_SIZE:]
+)
+# La validazione viene eseguita in thread separati da più sessioni contemporaneamente: la lettura e
+# l'aggiornamento della cache avvengono tenendo questo lock
+question_validity_lock = threading.Lock()
+
+
+class PromptPrefixLogger(BaseCallbackHandler):
+    """
+    Callback LangChain che registra nel log l'hash SHA-256 della parte iniziale di ogni prompt inviato al modello
+    - I prompt iniziano con la parte fissa (istruzioni, tool, schema del database) e terminano con quella che
+      cambia a ogni richiesta, così che il provider possa riutilizzare il prefisso già elaborato
+    - Se per lo stesso tipo di richiesta l'hash cambia tra una sessione e l'altra, nel prefisso è finito
+      un contenuto variabile da spostare in fondo al prompt
+    """
+
+    def log_prefix(self, prompt):
+        prefix = prompt.encode("utf-8")[:PROMPT_PREFIX_BYTES]
+        logger.debug("Prefisso del prompt (%d byte): sha256 %s", len(prefix), hashlib.sha256(prefix).hexdigest())
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        for prompt in prompts:
+            self.log_prefix(prompt)
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        for message_list in messages:
+            self.log_prefix(get_buffer_string(message_list))
+
+
+def save_question_validity_cache():
+    """
+    Funzione per salvare su disco gli esiti della validazione delle domande
+    - Viene registrata con atexit ed eseguita alla chiusura del processo; l'ordine delle chiavi nel file
+      conserva quello di utilizzo
+    """
+    with question_validity_lock:
+        saved_results = dict(question_validity_cache)
+    if saved_results:
+        write_json_file(QUESTION_VALIDITY_CACHE_FILE, saved_results)
+
+
+atexit.register(save_question_validity_cache)
 
 
 def init_chain(llm, db):
@@ -33,19 +105,41 @@ def init_chain(llm, db):
     return query_chain
 
 
+def get_schema_hash(db_schema):
+    """
+    Funzione per calcolare un identificativo breve dello schema del database
+    - Usa BLAKE2b con un digest di 8 byte, sufficiente a distinguere le versioni dello schema
+    :param db_schema: schema del database locale
+    :return: stringa esadecimale dell'hash dello schema
+    """
+    return hashlib.blake2b(db_schema.encode("utf-8"), digest_size=8).hexdigest()
+
+
 def is_question_valid_for_db(question, llm, db_schema):
     """
     Funzione per verificare se una domanda in linguaggio naturale è semanticamente compatibile con
     lo schema del database
+    - Se la stessa domanda (ignorando maiuscole e spazi iniziali/finali) è già stata validata con lo
+      stesso schema e modello, restituisce l'esito in cache senza chiamare il modello; lo schema è
+      identificato dal suo hash, così che la chiave resti breve e uguale tra riavvii
     - Carica un prompt da file esterno
     - Costruisce una catena LangChain con il prompt, il modello LLM e un parser
     - Passa la domanda e lo schema al modello
-    - Interpreta la risposta come booleano
+    - Interpreta la risposta come booleano e la salva in cache, eliminando l'esito usato meno di recente
+      se la cache supera QUESTION_VALIDITY_CACHE_SIZE elementi
+    - Legge e aggiorna la cache tenendo question_validity_lock, perché la funzione viene chiamata da più
+      thread contemporaneamente (la chiamata al modello avviene invece senza lock)
     :param question: domanda in linguaggio natuarale dell'utente
     :param llm: modello LLM
     :param db_schema: schema del database locale
     :return: True se la domanda è compatibile, altrimenti False
     """
+    cache_key = "\0".join((question.lower().strip(), get_schema_hash(db_schema), getattr(llm, "model_name", "")))
+    with question_validity_lock:
+        if cache_key in question_validity_cache:
+            question_validity_cache.move_to_end(cache_key)
+            return question_validity_cache[cache_key]
+
     prompt_text = load_prompt("Modules/AI_prompts/question_validity_prompt.txt")
 
     prompt = PromptTemplate.from_template(prompt_text)
@@ -55,7 +149,14 @@ def is_question_valid_for_db(question, llm, db_schema):
         "schema": db_schema
     })
 
-    return "true" in result.strip().lower()
+    is_valid = "true" in result.strip().lower()
+
+    with question_validity_lock:
+        question_validity_cache[cache_key] = is_valid
+        if len(question_validity_cache) > QUESTION_VALIDITY_CACHE_SIZE:
+            question_validity_cache.popitem(last=False)
+
+    return is_valid
 
 
 def is_query_valid_for_db(sql_query, llm, db_schema):
@@ -84,15 +185,42 @@ def is_query_valid_for_db(sql_query, llm, db_schema):
     return "true" in result.strip().lower()
 
 
-def format_model_answer(raw_result, llm):
+def are_questions_equivalent(question, cached_question, llm):
+    """
+    Funzione per verificare se una nuova domanda chiede la stessa informazione di una domanda a cui
+    è già stata data una risposta
+    - Carica un prompt da file esterno
+    - Costruisce una catena LangChain con il prompt, il modello LLM e un parser
+    - Passa le due domande al modello
+    - Interpreta la risposta come booleano
+    :param question: nuova domanda in linguaggio naturale dell'utente
+    :param cached_question: domanda simile già presente nella cache delle risposte
+    :param llm: modello LLM
+    :return: True se le domande sono equivalenti, altrimenti False
+    """
+    prompt_text = load_prompt("Modules/AI_prompts/question_equivalence_prompt.txt")
+
+    prompt = PromptTemplate.from_template(prompt_text)
+    chain = prompt | llm | StrOutputParser()
+    result = chain.invoke({
+        "question": question,
+        "cached_question": cached_question
+    })
+
+    return "true" in result.strip().lower()
+
+
+def format_model_answer(raw_result, llm, callbacks=None):
     """
     Funzione per generare una risposta formattata e tradotta in italiano a partire dal risultato di una query SQL
     - Controlla se il risultato della query è vuoto e in caso da un messaggio di nessun risultato
     - Carica un prompt da file esterno
     - Inserisce dinamicamente la query e il risultato nel prompt
-    - Invia il prompt al modello LLM
+    - Invia il prompt al modello LLM con il tag FINAL_ANSWER_TAG, così che i suoi token possano essere
+      mostrati in streaming mentre vengono generati
     :param raw_result: risultato grezzo della query eseguita sul database
     :param llm: modello LLM
+    :param callbacks: callback LangChain dell'esecuzione dell'agente, a cui inviare gli eventi della chiamata
     :return: stringa con la risposta finale formattata in italiano
     """
     if raw_result == "[]":
@@ -102,7 +230,7 @@ def format_model_answer(raw_result, llm):
 
     prompt_text = load_prompt("Modules/AI_prompts/format_answer_prompt.txt")
     formatted_prompt = prompt_text.format(result=raw_result)
-    response = llm.invoke(formatted_prompt)
+    response = llm.invoke(formatted_prompt, config={"callbacks": callbacks, "tags": [FINAL_ANSWER_TAG]})
 
     return response.content.strip()
 
@@ -147,21 +275,34 @@ def build_query_validator_tool(llm, db_schema):
     )
 
 
-def build_query_executor_tool(db):
+def build_query_executor_tool(engine):
     """
     Funzione che crea un tool LangChain che esegue una query SQL sul database locale
-    - Usa db.run() per eseguire la query
+    - Esegue la query direttamente con l'engine SQLAlchemy del database
+    - Restituisce le righe come lista JSON, che può essere riletta con orjson senza dover interpretare
+      la rappresentazione testuale Python delle tuple
+    - Se il chiamante ha impostato query_results, vi aggiunge anche i nomi delle colonne e le righe come
+      liste Python
     - Se la query non restituisce un risultato, ritorna "[]"
-    :param db: oggetto SQLDatabase connesso al database locale
+    :param engine: engine SQLAlchemy connesso al database locale
     :return: oggetto Tool utilizzabile da un agente che restituisce il risultato grezzo della query
     """
     def execute_query(sql_query):
+        collected_results = query_results.get()
         try:
-            result = db.run(sql_query)
-            return result if result else "[]"
+            with engine.connect() as conn:
+                result = conn.execute(text(sql_query))
+                columns = list(result.keys())
+                rows = [list(row) for row in result.fetchall()]
         except Exception as e:
+            if collected_results is not None:
+                collected_results.append(None)
             return f"Error during query execution: {str(e)}"
 
+        if collected_results is not None:
+            collected_results.append({"columns": columns, "rows": rows})
+        return orjson.dumps(rows, default=str).decode("utf-8")
+
     return Tool(
         name="QueryExecutor",
         func=execute_query,
@@ -173,12 +314,13 @@ def build_answer_formatter_tool(llm):
     """
     Funzione che crea un tool LangChain che formatta e traduce in italiano la risposta del modello con il
     risultato di una query SQL
-    - Usa format_model_answer per generare la risposta
+    - Usa format_model_answer per generare la risposta, passando le callback ricevute dall'agente così
+      che i token della risposta siano disponibili a chi esegue l'agente con astream_events
     :param llm: modello LLM
     :return: oggetto Tool utilizzabile da un agente che restituisce la risposta come stringa formattata
     """
-    def format_answer(raw_result):
-        return format_model_answer(raw_result, llm)
+    def format_answer(raw_result, callbacks=None):
+        return format_model_answer(raw_result, llm, callbacks)
 
     return Tool(
         name="AnswerFormatter",
@@ -192,7 +334,10 @@ def build_custom_agent(llm_key):
     """
     Funzione che inizializza un agente LangChain personalizzato per l'interrogazione di un database SQL
     tramite linguaggio naturale
-    - Configura il modello LLM llama3 tramite endpoint Groq, utilizzando l'API key fornita
+    - Configura il modello LLM llama3 tramite endpoint Groq, utilizzando l'API key fornita e ripetendo
+      le chiamate con attesa esponenziale in caso di rate limit (errore 429) o errori di connessione;
+      PromptPrefixLogger registra l'hash dell'inizio di ogni prompt per verificare che resti costante
+    - Lo schema del database viene letto una sola volta, così che sia identico in tutti i prompt
     - Crea la connessione al database SQLite locale e ottiene il suo schema
     - Costruisce i tool personalizzati per:
         - Validare semanticamente la domanda
@@ -209,15 +354,18 @@ def build_custom_agent(llm_key):
         temperature=0,
         openai_api_key=llm_key,
         openai_api_base="https://api.groq.com/openai/v1",
+        max_retries=5,
+        callbacks=[PromptPrefixLogger()],
     )
 
-    db = SQLDatabase.from_uri("sqlite:///documents.db")
+    engine = create_engine("sqlite:///documents.db")
+    db = SQLDatabase(engine)
     db_schema = db.get_table_info()
 
     # Costruisce i tool
     sql_query_tool = build_sql_query_tool(llm, db)
     query_validator_tool = build_query_validator_tool(llm, db_schema)
-    query_executor_tool = build_query_executor_tool(db)
+    query_executor_tool = build_query_executor_tool(engine)
     answer_formatter_tool = build_answer_formatter_tool(llm)
 
     # Lista dei tool da fornire all'agente
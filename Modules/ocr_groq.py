@@ -1,67 +1,252 @@
 import streamlit as st
-from PIL import Image
-from groq import Groq
+from PIL import Image, ImageOps
+from groq import Groq, AsyncGroq, RateLimitError, APIConnectionError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+import asyncio
 import base64
-import time
+import io
 import json
-import re
+import orjson
 import os
+import threading
 import joblib
-import pandas as pd
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from streamlit_ace import st_ace
 
-from Database.db_manager import insert_data, get_data
+from Database.db_manager import insert_with_children, get_data, get_persistent_connection
 from Modules.ML.ml_dataset import extract_features_from_receipt
+from Modules.prompts import load_prompt
+from Modules.receipt_schema import get_receipt_validation_errors
+from Modules.llm_cache import (build_cache_key, get_cached_response, save_cached_response, delete_cached_response,
+                               cache_stats)
 
 
 IMAGE_DIR = "Images"
+LLM_IMAGE_CACHE_DIR = os.path.join(IMAGE_DIR, ".cache")  # immagini già ridotte per l'invio al modello
 EXTRACTED_JSON_DIR = "Extracted_JSON"
+GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+OCR_MAX_CONCURRENCY = 8  # numero massimo di chiamate OCR contemporanee verso Groq
+OCR_REQUESTS_PER_MINUTE = 30  # limite di richieste al minuto del modello Groq
+GROQ_MAX_ATTEMPTS = 5  # tentativi massimi per chiamata in caso di rate limit o errori di connessione
+GROQ_MAX_WAIT = 47  # attesa massima (in secondi) tra due tentativi
+# Feature numeriche nell'ordine usato in fase di training, seguite dalla codifica one-hot della stagione
+ML_NUMERIC_FEATURES = ("day_of_week", "month", "is_holiday", "total_price", "n_items", "spending_per_item")
+LLM_IMAGE_MAX_SIDE = 1024  # lato massimo (in pixel) dell'immagine inviata al modello
+LLM_IMAGE_JPEG_QUALITY = 85
+LLM_IMAGE_PASSTHROUGH_BYTES = 200 * 1024  # sotto questa dimensione un JPEG già piccolo viene inviato così com'è
+PREVIEW_MAX_SIDE = 1200  # lato massimo (in pixel) dell'anteprima mostrata nell'interfaccia
+BASE64_CHUNK_BYTES = 57 * 1024  # blocco di lettura per la codifica base64, multiplo di 3
+EXIF_ORIENTATION_TAG = 0x0112  # tag EXIF con la rotazione da applicare alle foto scattate da telefono
+
+# La connessione restituita da get_db_connection è condivisa da tutte le sessioni Streamlit e dai loro thread:
+# ogni lettura o scrittura su di essa deve avvenire tenendo questo lock, così che commit e rollback di una
+# sessione non agiscano sulle operazioni ancora in corso di un'altra
+db_lock = threading.Lock()
+
+# Crea la cartella 'Extracted_JSON' una sola volta, all'importazione del modulo
+os.makedirs(EXTRACTED_JSON_DIR, exist_ok=True)
+
+
+def encode_file_base64(file_path):
+    """
+    Funzione per codificare in base64 il contenuto di un file leggendolo a blocchi
+    - Legge il file in blocchi di BASE64_CHUNK_BYTES, multiplo di 3, così che la codifica dei singoli
+      blocchi concatenata sia identica alla codifica dell'intero file
+    - Evita di tenere in memoria i byte originali dell'intero file insieme alla loro codifica
+    :param file_path: percorso del file da codificare
+    :return: stringa in base 64 del contenuto del file
+    """
+    encoded = bytearray()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(BASE64_CHUNK_BYTES):
+            encoded += base64.b64encode(chunk)
+    return encoded.decode("ascii")
+
+
+def prepare_image_for_llm(img_path):
+    """
+    Funzione per ottenere la versione ridotta di un'immagine da inviare al modello AI
+    - Cerca l'immagine già ridotta in LLM_IMAGE_CACHE_DIR, con un nome ottenuto dall'hash di percorso,
+      data di modifica e dimensione del file, così che un file modificato venga ridotto di nuovo
+    - Altrimenti ruota l'immagine secondo l'orientamento EXIF (la ricodifica elimina il tag, quindi le foto
+      da telefono risulterebbero ruotate), la riduce al lato massimo LLM_IMAGE_MAX_SIDE mantenendo le
+      proporzioni, la ricodifica in JPEG e la salva nella cartella di cache per le esecuzioni successive
+    :param img_path: percorso dell'immagine originale
+    :return: bytes dell'immagine ridotta in formato JPEG
+    """
+    stat = os.stat(img_path)
+    cache_name = build_cache_key(os.path.abspath(img_path), stat.st_mtime_ns, stat.st_size, LLM_IMAGE_MAX_SIDE,
+                                 "exif_transpose")
+    cache_path = os.path.join(LLM_IMAGE_CACHE_DIR, cache_name + ".jpg")
+
+    try:
+        with open(cache_path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+
+    with Image.open(img_path) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((LLM_IMAGE_MAX_SIDE, LLM_IMAGE_MAX_SIDE), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=LLM_IMAGE_JPEG_QUALITY, optimize=True)
 
+    # Scrive su un file temporaneo e lo rinomina, così che un'interruzione non lasci un file incompleto
+    os.makedirs(LLM_IMAGE_CACHE_DIR, exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(buffer.getbuffer())
+    os.replace(tmp_path, cache_path)
 
-def encode_image(img_path):
+    return buffer.getvalue()
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def encode_image(img_path, mtime):
     """
     Funzione per codificare l'immagine in Base64
-    - Apre il file in lettura binaria
-    - Legge il contenuto e lo converte in una stringa in base 64
-    - Decodifica in un formato leggibile "utf-8"
+    - Il risultato viene memorizzato in cache, così che le esecuzioni successive dello script Streamlit
+      non debbano rileggere e ricodificare la stessa immagine; la data di modifica del file fa parte
+      della chiave, quindi la cache si invalida se l'immagine cambia
+    - Apre l'immagine e ne legge formato e dimensioni
+    - Se è già un JPEG piccolo (peso e risoluzione entro i limiti) e non deve essere ruotato secondo
+      l'orientamento EXIF, usa il file originale così com'è
+    - Altrimenti usa la versione ridotta e ricodificata in JPEG da prepare_image_for_llm, per ridurre
+      i byte da inviare al modello
+    - Converte il contenuto in una stringa in base 64
+    - Decodifica in stringa "ascii", sufficiente per i caratteri del base64
     :param img_path: percorso dell'immagine da codificare
-    :return: stringa in base 64 dell'immagine
+    :param mtime: data di ultima modifica del file, usata solo come parte della chiave della cache
+    :return: stringa in base 64 dell'immagine (in formato JPEG)
     """
-    with open(img_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    with Image.open(img_path) as img:
+        if (img.format == "JPEG" and max(img.size) <= LLM_IMAGE_MAX_SIDE
+                and os.path.getsize(img_path) < LLM_IMAGE_PASSTHROUGH_BYTES
+                and img.getexif().get(EXIF_ORIENTATION_TAG, 1) == 1):
+            return encode_file_base64(img_path)
+
+    return base64.b64encode(prepare_image_for_llm(img_path)).decode("ascii")
 
 
-def load_prompt(file_path):
+@st.cache_data(max_entries=32, show_spinner=False)
+def load_preview(img_path, mtime):
     """
-    Funzione per caricare il file di testo con il prompt da passare all'AI
-    - Apre il file in lettura
-    - Decodifica in un formato leggibile "utf-8"
-    - Rimuove eventuali spazi bianchi o caratteri di nuova riga all'inizio e alla fine del testo
-    :param file_path: percorso del file con il prompt da caricare
-    :return: stringa di testo corrispondente al prompt
+    Funzione per ottenere l'anteprima di un'immagine da mostrare nell'interfaccia
+    - Ruota l'immagine secondo l'orientamento EXIF, che la ricodifica eliminerebbe senza applicarlo
+    - Riduce l'immagine al lato massimo PREVIEW_MAX_SIDE e la ricodifica in JPEG, così che al browser
+      non venga inviata ogni volta la foto originale a piena risoluzione
+    - Il risultato viene memorizzato in cache e condiviso tra anteprima e schermata di correzione del
+      JSON; la data di modifica del file fa parte della chiave, quindi la cache si invalida se l'immagine cambia
+    :param img_path: percorso dell'immagine
+    :param mtime: data di ultima modifica del file, usata solo come parte della chiave della cache
+    :return: bytes dell'anteprima in formato JPEG
     """
-    with open(file_path, "r", encoding="utf-8") as file:
-        return file.read().strip()
+    with Image.open(img_path) as img:
+        img = ImageOps.exif_transpose(img).convert("RGB")
+        img.thumbnail((PREVIEW_MAX_SIDE, PREVIEW_MAX_SIDE), Image.LANCZOS)
+        buffer = io.BytesIO()
+        img.save(buffer, format="JPEG", quality=LLM_IMAGE_JPEG_QUALITY)
+    return buffer.getvalue()
+
+
+@st.cache_resource(show_spinner=False)
+def get_groq_client(api_key):
+    """
+    Funzione per ottenere il client Groq da usare per le chiamate al modello AI
+    - Il client viene creato una sola volta per chiave API e poi riutilizzato tra le esecuzioni
+      dello script Streamlit, mantenendo aperte le connessioni HTTP già stabilite
+    - I tentativi automatici del client sono disattivati, perché gestiti da create_chat_completion
+    :param api_key: chiave per le chiamate API
+    :return: client Groq
+    """
+    return Groq(api_key=api_key, max_retries=0)
+
+
+exponential_wait = wait_exponential(multiplier=1, min=1, max=GROQ_MAX_WAIT)
+
+
+def wait_for_retry(retry_state):
+    """
+    Funzione per calcolare l'attesa prima di ripetere una chiamata a Groq non riuscita
+    - Se la risposta di errore contiene l'header Retry-After, attende il tempo indicato dal server
+    - Altrimenti usa un'attesa esponenziale (1s, 2s, 4s, ...) fino a GROQ_MAX_WAIT secondi
+    :param retry_state: stato del tentativo corrente fornito da tenacity
+    :return: secondi da attendere prima del tentativo successivo
+    """
+    response = getattr(retry_state.outcome.exception(), "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        return min(float(retry_after), GROQ_MAX_WAIT)
+    except (TypeError, ValueError):
+        return exponential_wait(retry_state)
+
+
+groq_retry = retry(
+    retry=retry_if_exception_type((RateLimitError, APIConnectionError)),
+    wait=wait_for_retry,
+    stop=stop_after_attempt(GROQ_MAX_ATTEMPTS),
+    reraise=True
+)
+
+
+@groq_retry
+def create_chat_completion(client, **kwargs):
+    """
+    Funzione per eseguire una chiamata al modello AI tramite il client Groq
+    - Ripete la chiamata in caso di rate limit (errore 429) o di errori di connessione temporanei,
+      con attesa crescente tra un tentativo e l'altro, invece di interrompere l'elaborazione
+    - Dopo GROQ_MAX_ATTEMPTS tentativi non riusciti rilancia l'ultimo errore
+    :param client: client Groq da utilizzare per la chiamata
+    :param kwargs: parametri della chiamata (modello, messaggi, ...)
+    :return: risposta del modello
+    """
+    return client.chat.completions.create(**kwargs)
+
+
+@groq_retry
+async def create_chat_completion_async(client, **kwargs):
+    """
+    Funzione asincrona per eseguire una chiamata al modello AI tramite il client AsyncGroq
+    - Ripete la chiamata con la stessa logica di create_chat_completion, attendendo senza bloccare
+      le altre chiamate in corso
+    :param client: client AsyncGroq da utilizzare per la chiamata
+    :param kwargs: parametri della chiamata (modello, messaggi, ...)
+    :return: risposta del modello
+    """
+    return await client.chat.completions.create(**kwargs)
+
+
+@st.cache_resource(show_spinner=False)
+def get_db_connection():
+    """
+    Funzione per ottenere la connessione al database usata dal flusso OCR/JSON
+    - La connessione viene aperta una sola volta e poi riutilizzata tra le esecuzioni dello script
+      Streamlit, evitando di riaprire il database a ogni lettura o inserimento
+    - La connessione è condivisa da tutte le sessioni: va usata solo tenendo db_lock
+    :return: connessione al database 'documents.db'
+    """
+    return get_persistent_connection("documents.db")
 
 
 def save_json_to_folder(json_content, filename):
     """
     Funzione per salvare un file JSON nella cartella 'Extracted_JSON'
-    - Crea la cartella 'Extracted_JSON' se non esiste già
     - Costruisce il percorso completo del file JSON all’interno della cartella
-    - Salva il contenuto JSON in formato testo con codifica UTF-8
-    - Se il file esiste già, non sovrascrive
-    :param json_content: contenuto JSON da salvare (stringa)
+    - Salva il contenuto JSON così com'è in formato binario (già codificato in UTF-8)
+    - Apre il file in modalità di creazione esclusiva: se il file esiste già l'apertura fallisce
+      e non viene sovrascritto (un solo accesso al disco, senza controllo preliminare)
+    :param json_content: contenuto JSON da salvare (bytes codificati in UTF-8)
     :param filename: nome del file .json
     :return: percorso del file salvato oppure None se il file esiste già
     """
-    os.makedirs(EXTRACTED_JSON_DIR, exist_ok=True)
     file_path = os.path.join(EXTRACTED_JSON_DIR, filename)
-    if os.path.exists(file_path):
+    try:
+        with open(file_path, "xb") as f:
+            f.write(json_content)
+    except FileExistsError:
         st.warning(f"JSON file '{filename}' already exists in the folder. No action taken.")
         return None
-    with open(file_path, "w", encoding="utf-8") as f:
-        f.write(json_content)
     return file_path
 
 
@@ -81,94 +266,336 @@ def delete_json_from_folder(filename):
 def parse_json_from_string(text):
     """
     Funzione per estrarre il primo oggetto JSON completo dal testo
-    - Utilizza regex per cercare un blocco JSON (tra parentesi graffe) nel testo
+    - Cerca la prima parentesi graffa aperta nel testo
+    - Scorre il testo una sola volta tenendo traccia della profondità delle parentesi graffe,
+      ignorando quelle contenute nelle stringhe (e i caratteri di escape al loro interno)
+    - Restituisce il blocco compreso tra la prima graffa e quella che la chiude
     :param text: stringa del testo estratto contenente il JSON più eventuale testo extra
     :return: stringa JSON estratta oppure None se non trovato
     """
-    pattern = re.compile(r'\{.*\}', re.DOTALL)
-    match = pattern.search(text)
-    if match:
-        return match.group(0)
+    start = text.find("{")
+    if start == -1:
+        return None
+
+    depth = 0
+    in_string = False
+    escape = False
+
+    for i in range(start, len(text)):
+        char = text[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif char == "\\":
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return text[start:i + 1]
+
     return None
 
 
+def load_ocr_response(raw_json_string):
+    """
+    Funzione per convertire in dizionario la risposta OCR {"testo_ocr": ..., "dati": {...}}
+    - Il testo OCR su più righe è contenuto in una stringa JSON, in cui il modello spesso inserisce gli
+      a capo senza escape: usa quindi json.loads con strict=False, che accetta i caratteri di controllo
+      all'interno delle stringhe (orjson li rifiuterebbe)
+    :param raw_json_string: stringa JSON estratta dalla risposta del modello
+    :return: dizionario con testo OCR e dati estratti
+    """
+    return json.loads(raw_json_string, strict=False)
+
+
+def is_valid_ocr_response(text):
+    """
+    Funzione per verificare che la risposta del modello OCR possa essere usata (e quindi salvata in cache)
+    - Estrae il primo oggetto JSON dal testo e verifica che possa essere letto con load_ocr_response: ad
+      esempio delle virgolette non escapate nel testo OCR producono parentesi bilanciate ma un JSON non valido
+    - Verifica che il campo "dati" contenga un oggetto
+    :param text: risposta del modello
+    :return: True se la risposta contiene un JSON valido con i dati dello scontrino, altrimenti False
+    """
+    raw_json_string = parse_json_from_string(text) if text else None
+    if not raw_json_string:
+        return False
+    try:
+        return isinstance(load_ocr_response(raw_json_string).get("dati"), dict)
+    except json.JSONDecodeError:
+        return False
+
+
+def get_ocr_cache_key(image_path, prompt_text):
+    """
+    Funzione per costruire la chiave di cache della chiamata OCR su un'immagine
+    - Legge il contenuto dell'immagine, così che la chiave dipenda dal file e non dal suo nome
+    - Combina immagine, prompt e modello in un'unica chiave
+    :param image_path: percorso dell'immagine
+    :param prompt_text: prompt OCR da passare all'AI
+    :return: chiave di cache della richiesta
+    """
+    with open(image_path, "rb") as image_file:
+        return build_cache_key(image_file.read(), prompt_text, GROQ_MODEL)
+
+
+def delete_ocr_cache_entry(image_path):
+    """
+    Funzione per eliminare dalla cache la risposta OCR di un'immagine
+    - Va chiamata prima di eliminare l'immagine, perché la chiave dipende dal contenuto del file
+    - Così, se lo stesso scontrino viene caricato di nuovo, l'OCR viene eseguito da capo invece di
+      restituire la risposta precedente
+    :param image_path: percorso dell'immagine
+    :return: True se la risposta è stata eliminata, False se non era in cache o l'immagine non esiste
+    """
+    if not os.path.exists(image_path):
+        return False
+    prompt_text = load_prompt("Modules/AI_prompts/ocr_prompt.txt")
+    return delete_cached_response(get_ocr_cache_key(image_path, prompt_text))
+
+
 def perform_ocr_on_image(api_key):
     """
-    Funzione per estrarre il testo da un'immagine attraverso l'OCR
+    Funzione per estrarre il testo e i dati strutturati da un'immagine con un'unica chiamata al modello AI
     - Recupera il percorso dell'immagine selezionata dallo stato della sessione Streamlit
+    - Se la stessa immagine con lo stesso prompt e modello è già stata elaborata, riutilizza la risposta
+      in cache senza chiamare il modello
     - Codifica l'immagine in base64 per l'invio al modello AI tramite il client Groq
-    - Esegue l'OCR ed estrae il testo
+    - Invia il prompt, identico per tutte le immagini, come messaggio di sistema iniziale e l'immagine
+      come messaggio utente, così che il prefisso comune possa essere riutilizzato dalla cache di Groq
+    - Esegue OCR ed estrazione del JSON ricevendo la risposta in streaming e mostra il testo parziale
+      mentre viene generato
+    - Chiude lo streaming appena la risposta contiene un oggetto JSON completo (controllando solo quando
+      arriva una parentesi graffa chiusa)
+    - Salva in cache la risposta solo se contiene un JSON valido con i dati dello scontrino (is_valid_ocr_response)
     :param api_key: chiave per le chiamate API
-    :return: testo estratto tramite OCR
+    :return: risposta del modello con il JSON {"testo_ocr": ..., "dati": {...}}
     """
     image_path = st.session_state.get("selected_image_path")
-
-    client = Groq(api_key=api_key)
-    base64_image = encode_image(image_path)
     prompt_text = load_prompt("Modules/AI_prompts/ocr_prompt.txt")
 
-    chat_completion = client.chat.completions.create(
-        model="meta-llama/llama-4-scout-17b-16e-instruct",
+    cache_key = get_ocr_cache_key(image_path, prompt_text)
+    cached_text = get_cached_response(cache_key)
+    if cached_text is not None:
+        return cached_text
+
+    client = get_groq_client(api_key)
+    base64_image = encode_image(image_path, os.path.getmtime(image_path))
+
+    chat_completion = create_chat_completion(
+        client,
+        model=GROQ_MODEL,
         messages=[
+            {"role": "system", "content": prompt_text},
             {"role": "user", "content": [
-                {"type": "text", "text": prompt_text},
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
             ]}
-        ]
+        ],
+        stream=True
     )
 
+    # Mostra il testo man mano che arriva, invece di attendere la risposta completa, e interrompe lo
+    # streaming appena il JSON è completo, senza attendere eventuale testo aggiuntivo del modello
+    placeholder = st.empty()
+    extracted_text = ""
+    for chunk in chat_completion:
+        if chunk.choices and chunk.choices[0].delta.content:
+            delta = chunk.choices[0].delta.content
+            extracted_text += delta
+            placeholder.text(extracted_text)
+            if "}" in delta and parse_json_from_string(extracted_text):
+                chat_completion.close()
+                break
+    placeholder.empty()
+
+    if is_valid_ocr_response(extracted_text):
+        save_cached_response(cache_key, extracted_text)
+
+    return extracted_text
+
+
+async def wait_for_request_slot(rate_limit):
+    """
+    Funzione asincrona per rispettare il limite di richieste al minuto verso Groq
+    - Distanzia l'avvio delle chiamate di almeno 60 / OCR_REQUESTS_PER_MINUTE secondi, così che un
+      batch numeroso non superi il limite anche se il semaforo consente più chiamate contemporanee
+    - Usa un lock per assegnare gli slot alle chiamate una alla volta, nell'ordine di arrivo
+    :param rate_limit: dizionario condiviso dal batch con il lock e l'istante del prossimo slot libero
+    """
+    async with rate_limit["lock"]:
+        loop = asyncio.get_running_loop()
+        delay = rate_limit["next_slot"] - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        rate_limit["next_slot"] = loop.time() + 60 / OCR_REQUESTS_PER_MINUTE
+
+
+async def perform_ocr_on_image_async(client, image_path, prompt_text, semaphore, rate_limit):
+    """
+    Funzione asincrona per estrarre il testo e i dati strutturati da un'immagine
+    - Se l'immagine è già stata elaborata, restituisce la risposta in cache senza chiamare il modello
+    - Attende che il semaforo consenta una nuova chiamata, per limitare le richieste contemporanee,
+      e che sia libero uno slot del limite di richieste al minuto
+    - Codifica l'immagine in base64 per l'invio al modello AI tramite il client Groq asincrono
+    - Esegue OCR ed estrazione del JSON senza bloccare le altre chiamate in corso
+    - Salva in cache la risposta solo se contiene un JSON valido con i dati dello scontrino (is_valid_ocr_response)
+    :param client: client AsyncGroq da utilizzare per la chiamata
+    :param image_path: percorso dell'immagine da elaborare
+    :param prompt_text: prompt da passare all'AI
+    :param semaphore: semaforo asyncio che limita il numero di chiamate contemporanee
+    :param rate_limit: stato del limite di richieste al minuto, condiviso dal batch
+    :return: risposta del modello con il JSON {"testo_ocr": ..., "dati": {...}}
+    """
+    cache_key = get_ocr_cache_key(image_path, prompt_text)
+    cached_text = get_cached_response(cache_key)
+    if cached_text is not None:
+        return cached_text
+
+    async with semaphore:
+        await wait_for_request_slot(rate_limit)
+        base64_image = encode_image(image_path, os.path.getmtime(image_path))
+        chat_completion = await create_chat_completion_async(
+            client,
+            model=GROQ_MODEL,
+            messages=[
+                {"role": "system", "content": prompt_text},
+                {"role": "user", "content": [
+                    {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"}}
+                ]}
+            ]
+        )
+
     extracted_text = chat_completion.choices[0].message.content
+    if is_valid_ocr_response(extracted_text):
+        save_cached_response(cache_key, extracted_text)
 
     return extracted_text
 
 
-def fix_json_data(api_key, json_data_dict, ocr_text):
+async def run_batch_ocr(api_key, image_paths):
+    """
+    Funzione asincrona per eseguire l'OCR su più immagini in parallelo
+    - Crea un client AsyncGroq condiviso tra tutte le chiamate
+    - Avvia contemporaneamente le chiamate OCR, limitandole a OCR_MAX_CONCURRENCY chiamate in corso
+      e a OCR_REQUESTS_PER_MINUTE avvii al minuto per rispettare i limiti di richieste di Groq
+    - Raccoglie i risultati senza interrompere il batch se una singola immagine fallisce
+    :param api_key: chiave per le chiamate API
+    :param image_paths: lista dei percorsi delle immagini da elaborare
+    :return: dizionario {percorso immagine: risposta del modello oppure eccezione in caso di errore}
+    """
+    prompt_text = load_prompt("Modules/AI_prompts/ocr_prompt.txt")
+    semaphore = asyncio.Semaphore(OCR_MAX_CONCURRENCY)
+    rate_limit = {"lock": asyncio.Lock(), "next_slot": 0.0}
+
+    async with AsyncGroq(api_key=api_key, max_retries=0) as client:
+        results = await asyncio.gather(
+            *(perform_ocr_on_image_async(client, path, prompt_text, semaphore, rate_limit) for path in image_paths),
+            return_exceptions=True
+        )
+
+    return dict(zip(image_paths, results))
+
+
+def perform_ocr_on_images(api_key, image_paths):
+    """
+    Funzione per eseguire l'OCR in batch sulle immagini selezionate
+    - Esegue in parallelo le chiamate OCR tramite run_batch_ocr, che salvano in cache le risposte
+      così che l'elaborazione successiva di ogni scontrino non debba ripetere la chiamata
+    - Individua le immagini per cui l'OCR non è riuscito: errori della chiamata o risposte che non superano
+      is_valid_ocr_response, lo stesso controllo usato per salvarle in cache
+    :param api_key: chiave per le chiamate API
+    :param image_paths: lista dei percorsi delle immagini da elaborare
+    :return: lista dei percorsi delle immagini per cui l'OCR non è riuscito
+    """
+    results = asyncio.run(run_batch_ocr(api_key, image_paths))
+
+    return [path for path, result in results.items()
+            if isinstance(result, Exception) or not is_valid_ocr_response(result)]
+
+
+@st.cache_data(show_spinner=False)
+def is_json_coherent_with_ocr(_api_key, ocr_text, json_string, validation_errors=None):
+    """
+    Funzione per verificare con il modello AI se il JSON estratto è coerente con il testo OCR
+    - Non contiene elementi dell'interfaccia, così che l'esito possa essere memorizzato in cache da
+      Streamlit: le esecuzioni successive dello script (ad esempio mentre l'utente modifica il JSON
+      nell'editor) non ripetono la chiamata finché testo OCR, JSON ed errori restano gli stessi
+    - Se lo stesso confronto è già nella cache delle risposte AI, riutilizza la risposta salvata
+    - Invia il prompt fisso come messaggio di sistema iniziale e il testo OCR, il JSON e gli eventuali
+      errori di formato come messaggio utente
+    :param _api_key: chiave per le chiamate API (esclusa dalla chiave della cache di Streamlit)
+    :param ocr_text: testo estratto tramite OCR
+    :param json_string: JSON estratto, come stringa formattata
+    :param validation_errors: errori di formato rilevati localmente sul JSON
+    :return: True se il modello conferma che i dati sono coerenti, altrimenti False
+    """
+    client = get_groq_client(_api_key)
+    prompt_text = load_prompt("Modules/AI_prompts/comparison_prompt.txt")
+
+    cache_key = build_cache_key(prompt_text, ocr_text, json_string, validation_errors or "", GROQ_MODEL)
+    comparison = get_cached_response(cache_key)
+    if comparison is None:
+        chat_completion = create_chat_completion(
+            client,
+            model=GROQ_MODEL,
+            messages=[
+                {"role": "system", "content": prompt_text},
+                {"role": "user", "content": [
+                    {"type": "text", "text": f"TESTO OCR:\n{ocr_text}"},
+                    {"type": "text", "text": f"JSON ESTRATTO:\n{json_string}"},
+                    {"type": "text", "text": f"ERRORI DI FORMATO:\n{validation_errors or 'nessuno'}"}
+                ]}
+            ]
+        )
+        comparison = chat_completion.choices[0].message.content.strip()
+        save_cached_response(cache_key, comparison)
+
+    return "DATI COERENTI" in comparison.upper()
+
+
+def fix_json_data(api_key, json_data_dict, ocr_text, validation_errors=None):
     """
     Funzione per verificare e correggere la coerenza tra testo OCR e dati JSON estratti
     - Recupera l'immagine e i dati estratti dallo stato della sessione Streamlit
     - Converte il JSON in una stringa formattata
-    - Invia il testo OCR e iol JSON al modello Groq per fare validazione semantica
+    - Verifica con is_json_coherent_with_ocr se testo OCR e JSON sono coerenti, considerando anche gli
+      eventuali errori di formato
     - Se i dati sono coerenti, conferma il contenuto
-    - Se ci sono discrepanze, mostra l'immagine e il JSON per una modifica manuale
+    - Se ci sono discrepanze, mostra l'anteprima dell'immagine (già in cache dopo la visualizzazione in
+      process_receipt) e il JSON per una modifica manuale
     - Consente la correzione diretta tramite editor Ace e conferma finale
     :param api_key: chiave per le chiamate API
     :param json_data_dict: dizionario estratto contenente i dati dello scontrino
     :param ocr_text: testo estratto tramite OCR
+    :param validation_errors: errori di formato rilevati localmente sul JSON, mostrati anche all'utente
     :return: dizionario JSON finale validato e corretto
     """
     image = st.session_state.get("selected_image")
     image_path = st.session_state.get("selected_image_path")
-    img = Image.open(image_path)
 
-    client = Groq(api_key=api_key)
-    prompt_text = load_prompt("Modules/AI_prompts/comparison_prompt.txt")
-    json_string = json.dumps(json_data_dict, indent=2, ensure_ascii=False)
-
-    chat_completion = client.chat.completions.create(
-        model="meta-llama/llama-4-scout-17b-16e-instruct",
-        messages=[
-            {"role": "user", "content": [
-                {"type": "text", "text": prompt_text},
-                {"type": "text", "text": f"TESTO OCR:\n{ocr_text}"},
-                {"type": "text", "text": f"JSON ESTRATTO:\n{json_string}"}
-            ]}
-        ]
-    )
-
-    comparison = chat_completion.choices[0].message.content.strip()
+    json_string = orjson.dumps(json_data_dict, option=orjson.OPT_INDENT_2).decode("utf-8")
     final_json_dict = json_data_dict
 
     # Se i dati sono coerenti, ritorna il dizionario originale
-    if "DATI COERENTI" in comparison.upper():
+    if is_json_coherent_with_ocr(api_key, ocr_text, json_string, validation_errors):
         st.success("I dati estratti sono coerenti con il testo OCR")
     # Altrimenti, permette all'utente di correggere il JSON
     else:
         st.warning("Sono state rilevate differenze tra il testo OCR e i dati estratti")
         st.info("Controlla e correggi i dati nel campo qui sotto prima di salvarli")
+        if validation_errors:
+            st.error(f"Errori di formato nei dati estratti:\n\n{validation_errors}")
 
         col1, col2 = st.columns([1, 1])
         with col1:
-            st.image(img, caption=f"Image: {image}", use_container_width=True)
+            st.image(load_preview(image_path, os.path.getmtime(image_path)), caption=f"Image: {image}",
+                     use_container_width=True)
         with col2:
             st.write("Dati JSON estratti (modificabili):")
 
@@ -186,7 +613,7 @@ def fix_json_data(api_key, json_data_dict, ocr_text):
         # Conferma modifica
         if st.button("Conferma dati corretti"):
             try:
-                st.session_state.corrected_json_final = json.loads(st.session_state.corrected_json_text)
+                st.session_state.corrected_json_final = orjson.loads(st.session_state.corrected_json_text)
                 st.success("Dati aggiornati correttamente")
             except Exception as e:
                 st.error(f"Errore nel JSON modificato: {e}")
@@ -206,15 +633,19 @@ def save_json_to_db(json_data, receipt_id):
     """
     Funzione per salvare i dati estratti dal JSON strutturato nel database
     - Riceve i dati già convertiti in dizionario JSON da un modello AI
-    - Inserisce un nuovo record nella tabella 'extracted_data' legandolo a 'receipt_id'
-    - Recupera l'ID della riga appena inserita in 'extracted_data'
-    - Inserisce ogni prodotto della lista 'lista_articoli' nella tabella 'receipt_items'
-      associandolo all'ID della tabella 'extracted_data'
-    - Se il record esiste già o c'è un errore, interrompe il flusso e restituisce un messaggio
+    - Inserisce un nuovo record nella tabella 'extracted_data' legandolo a 'receipt_id' e tutti i prodotti
+      della lista 'lista_articoli' nella tabella 'receipt_items', associati all'ID del nuovo record
+    - I due inserimenti avvengono in un'unica transazione con insert_with_children: se un prodotto non può
+      essere inserito vengono annullati entrambi, così che lo scontrino possa essere salvato di nuovo
+    - Se il record esiste già o c'è un errore, restituisce un messaggio
+    - Gli inserimenti avvengono tenendo db_lock, perché la connessione è condivisa tra le sessioni
     :param json_data: dizionario con i dati estratti dal testo OCR strutturato
     :param receipt_id: ID del record esistente nella tabella 'receipts'
     :return: "inserted" se inserimento riuscito, "exists" o "error: ..." in caso di problemi
     """
+    conn = get_db_connection()
+    total_price = json_data.get("prezzo_totale") or {}
+
     extracted_data_row = {
         "receipt_id": receipt_id,
         "purchase_date": json_data.get("data"),
@@ -223,22 +654,13 @@ def save_json_to_db(json_data, receipt_id):
         "address": json_data.get("indirizzo"),
         "city": json_data.get("città"),
         "country": json_data.get("paese"),
-        "total_price": json_data.get("prezzo_totale", {}).get("valore"),
-        "total_currency": json_data.get("prezzo_totale", {}).get("valuta"),
+        "total_price": total_price.get("valore"),
+        "total_currency": total_price.get("valuta"),
         "payment_method": json_data.get("metodo_pagamento")
     }
 
-    result = insert_data("documents.db", "extracted_data", extracted_data_row)
-    if result != "inserted":
-        return result  # si ferma se il record esiste già o c'è errore
-
-    extracted_data_rows = get_data("documents.db", "extracted_data", ["id"], {"receipt_id": receipt_id})
-    extracted_data_id = extracted_data_rows[-1][0] if extracted_data_rows else None
-    # [-1][0] per prendere l’ultimo ID appena inserito in extracted_data
-
-    for item in json_data.get("lista_articoli", []):
-        item_row = {
-            "extracted_data_id": extracted_data_id,
+    item_rows = [
+        {
             "name": item.get("nome"),
             "quantity": item.get("quantita"),
             "price": item.get("prezzo"),
@@ -247,20 +669,32 @@ def save_json_to_db(json_data, receipt_id):
             "absolute_discount": item.get("sconto_assoluto"),
             "discount_value": item.get("valore_scontato")
         }
-        insert_data("documents.db", "receipt_items", item_row)
+        for item in json_data.get("lista_articoli") or []
+    ]
 
-    return "inserted"
+    # La connessione è condivisa tra le sessioni: il lock impedisce che un commit o un rollback di un'altra
+    # sessione si inserisca nella transazione
+    with db_lock:
+        return insert_with_children("documents.db", "extracted_data", extracted_data_row, "receipt_items",
+                                    item_rows, "extracted_data_id", conn=conn)
 
 
 def run_ocr_and_save_json(api_key):
     """
     Funzione che esegue l'OCR su uno scontrino e genera il file JSON corrispondente
     - Recupera l'iimmagine e il percorso dallo stato della sessione Streamlit
-    - Applica l'OCR usando Groq e un'immagine codificata in base64
+    - Applica l'OCR e genera il JSON strutturato con un'unica chiamata a Groq, che restituisce sia
+      il testo OCR sia i dati estratti
+    - Durante la chiamata cerca in parallelo l'Id dello scontrino nel database, così che la query non
+      si aggiunga al tempo di attesa del modello
     - Mostra il testo OCR estratto, se richiesto, e valida che non sia vuoto
-    - Genera un JSON strutturato a partire dal testo OCR
-    - Salva il file JSON nella cartella
+    - Valida localmente il formato dei dati estratti e, solo se non è corretto, chiede la verifica e la
+      correzione tramite fix_json_data
     - Inserisce i dati estratti nel database associandoli allo scontrino originale
+    - Salva il file JSON nella cartella solo se i dati sono nel database, così che il file (che indica
+      uno scontrino già elaborato) non resti se l'inserimento non è riuscito
+    - Se Groq continua a rifiutare le richieste anche dopo i tentativi ripetuti, mostra un errore
+      invece di interrompere l'app
     :param api_key: chiave per le chiamate API
     :return: dizionario con dati strutturati, oppure None in caso di errore
     """
@@ -271,83 +705,109 @@ def run_ocr_and_save_json(api_key):
         st.warning("Nessuna immagine selezionata o file non trovato.")
         return
 
-    # Esegue l'OCR
-    ocr_text = perform_ocr_on_image(api_key)
-
-    # Mostra opzionalmente il testo OCR
-    if st.checkbox(f"Mostra testo OCR estratto da {image}"):
-        st.text_area("Testo OCR", ocr_text, height=200)
-
-    if not ocr_text.strip():
-        st.error("Testo OCR vuoto. Impossibile continuare.")
-        return
+    # Esegue l'OCR e l'estrazione del JSON in un'unica chiamata, cercando nel frattempo lo scontrino
+    # nel database in un thread separato; la ricerca apre una propria connessione, così da non dover
+    # attendere db_lock mentre altre sessioni usano quella condivisa
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        receipt_lookup = executor.submit(get_data, "documents.db", "receipts", "Id", {"File_path": image}, limit=1)
+        try:
+            extracted_data = perform_ocr_on_image(api_key)
+        except (RateLimitError, APIConnectionError):
+            st.error("Groq is rate limiting requests or unreachable. Please try again in a few minutes.")
+            return None
 
-    # Chiamata al modello Groq per generare JSON
-    json_filename = os.path.splitext(st.session_state.selected_image)[0] + ".json"
-    client = Groq(api_key=api_key)
-    prompt_text = load_prompt("Modules/AI_prompts/json_prompt.txt")
-
-    chat_completion = client.chat.completions.create(
-        model="meta-llama/llama-4-scout-17b-16e-instruct",
-        messages=[
-            {"role": "user", "content": [
-                {"type": "text", "text": prompt_text},
-                {"type": "text", "text": ocr_text}
-            ]}
-        ]
-    )
-
-    extracted_data = chat_completion.choices[0].message.content
     raw_json_string = parse_json_from_string(extracted_data.strip())
 
     if not raw_json_string:
         st.error("No JSON object found in extracted data. File not saved.")
         return None
 
+    json_filename = os.path.splitext(st.session_state.selected_image)[0] + ".json"
+
     # Corregge il JSON e lo salva
     try:
-        extracted_data_dict = json.loads(raw_json_string)
-        extracted_data_dict = fix_json_data(api_key, extracted_data_dict, ocr_text)
-        json_content = json.dumps(extracted_data_dict, ensure_ascii=False, indent=2)
+        ocr_response = load_ocr_response(raw_json_string)
+        ocr_text = ocr_response.get("testo_ocr") or ""
+        extracted_data_dict = ocr_response.get("dati")
+
+        # Mostra opzionalmente il testo OCR
+        if st.checkbox(f"Mostra testo OCR estratto da {image}"):
+            st.text_area("Testo OCR", ocr_text, height=200)
+
+        if not ocr_text.strip():
+            st.error("Testo OCR vuoto. Impossibile continuare.")
+            return None
+
+        if not isinstance(extracted_data_dict, dict):
+            st.error("No JSON object found in extracted data. File not saved.")
+            return None
+
+        # Chiede la verifica al modello solo se i dati non rispettano il formato atteso
+        validation_errors = get_receipt_validation_errors(extracted_data_dict)
+        if validation_errors:
+            extracted_data_dict = fix_json_data(api_key, extracted_data_dict, ocr_text, validation_errors)
+
+        rows = receipt_lookup.result()
+        receipt_id = rows[0][0] if rows else None
+        # [0][0] per prendere il primo elemento della prima riga, cioè il valore della colonna
+        # richiesta (in questo caso "Id")
+
+        if receipt_id is None:
+            st.error("No matching receipt found in database. File not saved.")
+            return None
+
+        # Il file JSON viene salvato solo dopo l'inserimento nel database: la sua presenza indica che lo
+        # scontrino è stato elaborato, quindi non deve esistere se i dati non sono stati salvati
+        db_result = save_json_to_db(extracted_data_dict, receipt_id)
+
+        if db_result == "inserted":
+            st.success("Data inserted into database.")
+        elif db_result == "exists":
+            st.warning("Data already exists in database.")
+        else:
+            st.error(f"Database error: {db_result}. File not saved.")
+            return None
+
+        json_content = orjson.dumps(extracted_data_dict, option=orjson.OPT_INDENT_2)
         json_path = save_json_to_folder(json_content, json_filename)
         if json_path:
             st.success(f"JSON file saved successfully at: {json_path}")
 
-            rows = get_data("documents.db", "receipts", "Id", {"File_path": image})
-            receipt_id = rows[0][0] if rows else None
-            # [0][0] per prendere il primo elemento della prima riga, cioè il valore della colonna
-            # richiesta (in questo caso "Id")
-
-            if receipt_id is None:
-                st.error("No matching receipt found in database.")
-                return None
-
-            db_result = save_json_to_db(extracted_data_dict, receipt_id)
-
-            if db_result == "inserted":
-                st.success("Data inserted into database.")
-            elif db_result == "exists":
-                st.warning("Data already exists in database.")
-            else:
-                st.error(f"Database error: {db_result}")
-
             st.session_state.last_generated_json = extracted_data_dict
             st.session_state.trigger_prediction = True
 
     except json.JSONDecodeError:
+        # Intercetta anche orjson.JSONDecodeError, che ne è una sottoclasse
         st.error("Generated data is not valid JSON. File not saved.")
         extracted_data_dict = None
+    except (RateLimitError, APIConnectionError):
+        st.error("Groq is rate limiting requests or unreachable. Please try again in a few minutes.")
+        extracted_data_dict = None
 
     return extracted_data_dict
 
 
+@st.cache_resource(show_spinner=False)
+def load_ml_artifacts():
+    """
+    Funzione per caricare scaler, modello ed encoder salvati in locale
+    - Gli oggetti vengono deserializzati una sola volta per processo e poi riutilizzati da tutte
+      le predizioni, invece di essere riletti dal disco a ogni richiesta
+    :return: scaler, modello ML, encoder
+    """
+    scaler = joblib.load("Modules/ML/ML_Objects/scaler.joblib")
+    model = joblib.load("Modules/ML/ML_Objects/final_model.joblib")
+    encoder = joblib.load("Modules/ML/ML_Objects/encoder.joblib")
+    return scaler, model, encoder
+
+
 def ml_predictions_from_json():
     """
     Funzione per effettuare la predizione su uno scontrino a partire da un file JSON:
-    - Carica scaler, encoder e modello ML salvati in locale
+    - Recupera scaler, encoder e modello ML salvati in locale, caricati una sola volta per processo
     - Estrae le feature rilevanti dallo scontrino
-    - Codifica le variabili categoriche con OneHotEncoder
-    - Costruisce il vettore delle feature nell'ordine atteso dal modello
+    - Codifica la stagione con le stesse colonne dell'OneHotEncoder salvato
+    - Costruisce direttamente l'array NumPy delle feature nell'ordine atteso dal modello
     - Trasforma le feature con lo scaler per normalizzarle
     - Esegue la predizione con il modello (0 = normale, 1 = anomalo)
     :return: risultato della previsione come valore intero, oppure None in caso di errore
@@ -357,24 +817,22 @@ def ml_predictions_from_json():
 
     json_data = st.session_state.last_generated_json
 
-    # Carica scaler, modello e encoder
-    scaler = joblib.load("Modules/ML/ML_Objects/scaler.joblib")
-    model = joblib.load("Modules/ML/ML_Objects/final_model.joblib")
-    encoder = joblib.load("Modules/ML/ML_Objects/encoder.joblib")
+    # Recupera scaler, modello e encoder già caricati
+    scaler, model, encoder = load_ml_artifacts()
 
     # Estrae le feature come dizionario
     feature_dict = extract_features_from_receipt(json_data)
     if feature_dict is None:
         return None
 
-    df = pd.DataFrame([feature_dict])
+    # Costruisce direttamente il vettore delle feature, senza passare da un DataFrame
+    numeric_features = np.array([feature_dict[name] for name in ML_NUMERIC_FEATURES], dtype=np.float64)
 
-    # Codifica la colonna categorica usando l'encoder salvato
-    encoded = encoder.transform(df[['season']])
-    encoded_df = pd.DataFrame(encoded, columns=encoder.get_feature_names_out(['season']), index=df.index)
-    df = pd.concat([df.drop(columns=['season']), encoded_df], axis=1)
+    # Codifica la stagione come l'encoder salvato: le colonne sono "season_<valore>" e la prima categoria
+    # (eliminata in fase di training) o una stagione sconosciuta corrispondono a tutti zeri
+    season_features = (encoder.get_feature_names_out(['season']) == f"season_{feature_dict['season']}")
 
-    X_new = df.drop(['date'], axis=1).values
+    X_new = np.hstack([numeric_features, season_features.astype(np.float64)]).reshape(1, -1)
 
     # Trasforma le feature e fa la previsione
     X_new_transf = scaler.transform(X_new)
@@ -386,31 +844,54 @@ def ml_predictions_from_json():
 def process_receipt(data, api_key):
     """
     Funzione per gestire l'interfaccia utente e il flusso OCR/JSON
+    - Mostra nella sidebar i contatori di hit e miss della cache delle risposte AI, aggiornati alla fine
+      dell'elaborazione
+    - Consente di eseguire in anticipo e in parallelo l'OCR su più immagini selezionate
     - Mostra le immagini selezionabili da elaborare
-    - Visualizza l’immagine corrente
-    - Consente di eseguire l’OCR e generare il JSON con pulsante dedicato
-    - Mostra una barra di caricamento durante l’elaborazione
+    - Visualizza l’anteprima ridotta dell’immagine corrente
+    - Se lo scontrino è già stato elaborato (il file JSON esiste già), mostra i dati salvati invece
+      di proporre di nuovo l'OCR, che non potrebbe comunque sovrascrivere il file o il database
+    - Altrimenti consente di eseguire l’OCR e generare il JSON con pulsante dedicato
+    - Mostra un indicatore di caricamento per tutta la durata dell’elaborazione
     - Esegue la classificazione ML se il flag è attivo
     - Mostra messaggio finale in base alla predizione
     :param data: dati presenti nel database
     :param api_key: chiave per le chiamate API
     """
     if data:
+        # Segnaposto aggiornato anche dopo l'elaborazione, così che i contatori includano le chiamate appena eseguite
+        cache_caption = st.sidebar.empty()
+        cache_caption.caption(f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+
+        with st.expander("Batch OCR"):
+            batch_images = st.multiselect("Select files to run OCR on in parallel", [row[1] for row in data])
+            if batch_images and st.button("Run OCR on selected files"):
+                with st.spinner("Running OCR on selected files..."):
+                    failed = perform_ocr_on_images(api_key, [os.path.join(IMAGE_DIR, name) for name in batch_images])
+                if failed:
+                    st.error(f"OCR failed for: {', '.join(os.path.basename(path) for path in failed)}")
+                else:
+                    st.success("OCR completed for all selected files.")
+
         selected_image = st.selectbox("Select file to process with OCR", [row[1] for row in data])
         image_path = os.path.join(IMAGE_DIR, selected_image)
         st.session_state['selected_image'] = selected_image
         st.session_state['selected_image_path'] = image_path
 
-        img = Image.open(image_path)
-        st.image(img, caption=f"Preview of {selected_image}", use_container_width=True)
+        st.image(load_preview(image_path, os.path.getmtime(image_path)), caption=f"Preview of {selected_image}",
+                 use_container_width=True)
 
-        if st.button(f"OCR and JSON for {selected_image}"):
-            with st.spinner("Processing OCR and JSON..."):
-                progress = st.progress(0)
-                for i in range(100):
-                    time.sleep(0.01)
-                    progress.progress(i + 1)
+        # Se lo scontrino è già stato elaborato mostra il JSON salvato, senza proporre un nuovo OCR
+        json_path = os.path.join(EXTRACTED_JSON_DIR, os.path.splitext(selected_image)[0] + ".json")
+        if os.path.exists(json_path):
+            st.info(f"{selected_image} has already been processed. Delete the file and upload it again "
+                    f"to run OCR on it a second time.")
+            with st.expander(f"Extracted data for {selected_image}"):
+                with open(json_path, "rb") as f:
+                    st.json(orjson.loads(f.read()))
 
+        elif st.button(f"OCR and JSON for {selected_image}"):
+            with st.spinner("Processing OCR and JSON..."):
                 extracted_data_dict = run_ocr_and_save_json(api_key)
                 st.session_state["last_generated_json"] = extracted_data_dict
 
@@ -428,5 +909,7 @@ def process_receipt(data, api_key):
             # Reset del flag per evitare chiamate ripetute
             st.session_state.trigger_prediction = False
 
+        cache_caption.caption(f"LLM cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+
     else:
         st.info("No data available in the database for processing.")
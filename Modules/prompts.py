@@ -0,0 +1,16 @@
+from functools import lru_cache
+
+
+@lru_cache(maxsize=16)
+def load_prompt(file_path):
+    """
+    Funzione per caricare il file di testo con il prompt da passare all'AI
+    - Apre il file in lettura
+    - Decodifica in un formato leggibile "utf-8"
+    - Rimuove eventuali spazi bianchi o caratteri di nuova riga all'inizio e alla fine del testo
+    - Il risultato viene memorizzato in cache: ogni prompt viene letto da disco una sola volta
+    :param file_path: percorso del file con il prompt da caricare
+    :return: stringa di testo corrispondente al prompt
+    """
+    with open(file_path, "r", encoding="utf-8") as file:
+        return file.read().strip()
@@ -0,0 +1,64 @@
+from typing import Optional
+from pydantic import BaseModel, ConfigDict, Field, ValidationError, model_validator
+
+
+# Modelli dei dati estratti da uno scontrino, con lo stesso formato richiesto dal prompt OCR: ogni campo
+# deve essere presente (eventualmente con valore null) e i vincoli numerici sono quelli delle tabelle
+# extracted_data e receipt_items del database
+
+
+class ItemModel(BaseModel):
+    model_config = ConfigDict(strict=True)
+
+    nome: str = Field(min_length=1)
+    quantita: Optional[int] = Field(ge=0)
+    prezzo: Optional[float] = Field(ge=0)
+    valuta: Optional[str] = Field(min_length=3, max_length=3)
+    percentuale_sconto: Optional[float] = Field(ge=0, le=100)
+    sconto_assoluto: Optional[float] = Field(ge=0)
+    valore_scontato: Optional[float] = Field(ge=0)
+
+    @model_validator(mode="after")
+    def check_discount(self):
+        if self.sconto_assoluto is not None and self.prezzo is not None and self.sconto_assoluto > self.prezzo:
+            raise ValueError("sconto_assoluto non può essere maggiore di prezzo")
+        return self
+
+
+class PriceModel(BaseModel):
+    model_config = ConfigDict(strict=True)
+
+    valore: Optional[float] = Field(ge=0)
+    valuta: Optional[str] = Field(min_length=3, max_length=3)
+
+
+class ReceiptModel(BaseModel):
+    model_config = ConfigDict(strict=True)
+
+    data: Optional[str] = Field(pattern=r"^\d{4}-\d{2}-\d{2}$")
+    ora: Optional[str] = Field(pattern=r"^\d{2}:\d{2}:\d{2}$")
+    negozio: Optional[str]
+    indirizzo: Optional[str]
+    citta: Optional[str] = Field(alias="città")
+    paese: Optional[str]
+    lista_articoli: list[ItemModel] = Field(min_length=1)
+    prezzo_totale: PriceModel
+    metodo_pagamento: Optional[str]
+
+
+def get_receipt_validation_errors(json_data):
+    """
+    Funzione per verificare che i dati estratti da uno scontrino rispettino il formato atteso
+    - Valida il dizionario con ReceiptModel, senza chiamate al modello AI
+    - In caso di errori, li riassume uno per riga indicando il campo coinvolto
+    :param json_data: dizionario con i dati estratti dallo scontrino
+    :return: stringa con gli errori di validazione, oppure None se i dati sono validi
+    """
+    try:
+        ReceiptModel.model_validate(json_data)
+    except ValidationError as e:
+        return "\n".join(
+            f"{'.'.join(str(part) for part in error['loc']) or 'scontrino'}: {error['msg']}"
+            for error in e.errors()
+        )
+    return None
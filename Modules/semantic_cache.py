@@ -0,0 +1,155 @@
+import atexit
+import os
+import re
+import unicodedata
+from difflib import SequenceMatcher
+
+from Modules.llm_cache import LLM_CACHE_DIR, read_json_file, write_json_file
+
+
+SEMANTIC_CACHE_DB = "documents.db"
+SEMANTIC_CACHE_FILE = os.path.join(LLM_CACHE_DIR, "semantic_cache.json")
+SEMANTIC_CACHE_SIZE = 256  # numero massimo di risposte memorizzate
+# La similarità testuale non distingue parole brevi ma decisive ("più"/"meno", "marzo"/"maggio" superano 0.92),
+# quindi la risposta viene riutilizzata direttamente solo se la domanda normalizzata è identica
+SEMANTIC_CACHE_SERVE_THRESHOLD = 1.0
+SEMANTIC_CACHE_CONFIRM_THRESHOLD = 0.80  # tra questa soglia e la precedente serve una conferma dal modello AI
+
+# Risposte già calcolate dall'agente, dalla meno alla più recente
+semantic_entries = []
+
+# Date di modifica del database a cui si riferiscono le risposte in cache
+semantic_cache_db_version = None
+
+
+def normalize_question(question):
+    """
+    Funzione per ridurre una domanda alla forma usata nel confronto tra domande simili
+    - Converte in minuscolo e rimuove gli accenti (ad esempio "più" e "piu" diventano uguali)
+    - Rimuove la punteggiatura e compatta gli spazi
+    :param question: domanda in linguaggio naturale dell'utente
+    :return: domanda normalizzata
+    """
+    decomposed = unicodedata.normalize("NFKD", question.lower())
+    without_accents = "".join(char for char in decomposed if not unicodedata.combining(char))
+    return " ".join(re.sub(r"[^\w\s]", " ", without_accents).split())
+
+
+def get_db_version(db_path):
+    """
+    Funzione per ottenere un identificativo dello stato attuale del database
+    - Usa le date di modifica del file del database e del suo file WAL, dove SQLite scrive le
+      modifiche prima di riportarle nel file principale
+    :param db_path: percorso del database
+    :return: tupla con le date di modifica dei file esistenti
+    """
+    return tuple(
+        os.path.getmtime(path) if os.path.exists(path) else None
+        for path in (db_path, db_path + "-wal")
+    )
+
+
+def invalidate_if_db_changed():
+    """
+    Funzione per svuotare la cache se il database è stato modificato
+    - Le risposte in cache dipendono dai dati presenti nel database, quindi un nuovo scontrino
+      o una cancellazione le rendono potenzialmente non più valide
+    """
+    global semantic_cache_db_version
+    db_version = get_db_version(SEMANTIC_CACHE_DB)
+    if db_version != semantic_cache_db_version:
+        semantic_entries.clear()
+        semantic_cache_db_version = db_version
+
+
+def find_similar_question(question):
+    """
+    Funzione per cercare nella cache la risposta a una domanda uguale o simile
+    - Svuota la cache se il database è cambiato dall'ultima risposta memorizzata
+    - Confronta la domanda normalizzata con quelle in cache tramite SequenceMatcher
+    - Considera solo domande con gli stessi numeri (ad esempio "primi 10" e "primi 15" sono domande
+      diverse anche se il testo è quasi identico)
+    :param question: domanda in linguaggio naturale dell'utente
+    :return: risposta in cache più simile e relativa similarità (tra 0 e 1), oppure None e 0.0 se
+             nessuna domanda raggiunge SEMANTIC_CACHE_CONFIRM_THRESHOLD
+    """
+    invalidate_if_db_changed()
+
+    normalized = normalize_question(question)
+    numbers = re.findall(r"\d+", normalized)
+    matcher = SequenceMatcher(None, b="")
+    matcher.set_seq2(normalized)
+
+    best_entry, best_similarity = None, 0.0
+    for entry in semantic_entries:
+        if entry["numbers"] != numbers:
+            continue
+        matcher.set_seq1(entry["question"])
+        # real_quick_ratio e quick_ratio sono limiti superiori economici della similarità
+        if matcher.real_quick_ratio() <= best_similarity or matcher.quick_ratio() <= best_similarity:
+            continue
+        similarity = matcher.ratio()
+        if similarity > best_similarity:
+            best_entry, best_similarity = entry, similarity
+
+    if best_similarity < SEMANTIC_CACHE_CONFIRM_THRESHOLD:
+        return None, 0.0
+    return best_entry, best_similarity
+
+
+def add_to_semantic_cache(question, sql_query, raw_result, final_answer, columns=None):
+    """
+    Funzione per memorizzare nella cache la risposta dell'agente a una domanda
+    - Sostituisce l'eventuale risposta già presente per la stessa domanda normalizzata
+    - Elimina la risposta meno recente se la cache supera SEMANTIC_CACHE_SIZE elementi
+    :param question: domanda in linguaggio naturale dell'utente
+    :param sql_query: query SQL generata dall'agente
+    :param raw_result: risultato grezzo della query
+    :param final_answer: risposta finale dell'agente
+    :param columns: nomi delle colonne del risultato, se disponibili
+    """
+    invalidate_if_db_changed()
+
+    normalized = normalize_question(question)
+    semantic_entries[:] = [entry for entry in semantic_entries if entry["question"] != normalized]
+    semantic_entries.append({
+        "question": normalized,
+        "numbers": re.findall(r"\d+", normalized),
+        "original_question": question,
+        "sql_query": sql_query,
+        "raw_result": raw_result,
+        "final_answer": final_answer,
+        "columns": columns
+    })
+    if len(semantic_entries) > SEMANTIC_CACHE_SIZE:
+        del semantic_entries[0]
+
+
+def load_semantic_cache():
+    """
+    Funzione per caricare la cache delle risposte salvata su disco all'ultima chiusura del processo
+    - Ripristina anche la versione del database a cui si riferiscono le risposte, così che vengano scartate
+      alla prima ricerca se il database è stato modificato nel frattempo
+    - Se il file non esiste o non è valido, parte da una cache vuota
+    """
+    global semantic_cache_db_version
+    saved = read_json_file(SEMANTIC_CACHE_FILE, {})
+    db_version = saved.get("db_version")
+    semantic_entries[:] = saved.get("entries", [])[-SEMANTIC_CACHE_SIZE:]
+    semantic_cache_db_version = tuple(db_version) if db_version is not None else None
+
+
+def save_semantic_cache():
+    """
+    Funzione per salvare su disco la cache delle risposte e la versione del database a cui si riferiscono
+    - Viene registrata con atexit ed eseguita alla chiusura del processo
+    """
+    if semantic_entries:
+        write_json_file(SEMANTIC_CACHE_FILE, {
+            "db_version": semantic_cache_db_version,
+            "entries": semantic_entries
+        })
+
+
+load_semantic_cache()
+atexit.register(save_semantic_cache)
@@ -1,24 +1,97 @@
 import chainlit as cl
-import streamlit as st
 import ast
+import asyncio
+import io
+import logging
+import orjson
+import os
+import sqlite3
+import unicodedata
+from itertools import islice
+from functools import lru_cache
+from openai import RateLimitError
+from sqlalchemy.exc import SQLAlchemyError
 
-from Modules.llm_functions import is_question_valid_for_db, build_custom_agent
+from Modules.config import get_secret
+from Modules.llm_functions import (is_question_valid_for_db, are_questions_equivalent, build_custom_agent,
+                                   query_results, FINAL_ANSWER_TAG)
+from Modules.semantic_cache import find_similar_question, add_to_semantic_cache, SEMANTIC_CACHE_SERVE_THRESHOLD
 
 # Frasi da filtrare
-COURTESY_MESSAGES = [
+COURTESY_MESSAGES = frozenset({
     "grazie", "grazie mille", "ti ringrazio", "ok", "ok grazie", "va bene",
     "va bene grazie", "capito", "tutto chiaro", "ricevuto", "bene",
     "perfetto", "chiaro", "ottimo", "eccellente"
-]
+})
 
-GREETING_MESSAGES = [
+GREETING_MESSAGES = frozenset({
     "ciao", "salve", "buongiorno", "buonasera", "hey", "ehi"
-]
+})
+
+# Risposta rapida per ogni frase da filtrare, così che un solo accesso al dizionario copra saluti e cortesie
+FAST_REPLIES = {
+    **dict.fromkeys(COURTESY_MESSAGES, "Prego! Fammi sapere se hai altre domande."),
+    **dict.fromkeys(GREETING_MESSAGES, "Ciao! Chiedimi pure, sono qui per aiutarti.")
+}
 
 MAX_RIGHE = 30  # numero massimo di righe consentite
+RIGHE_ANTEPRIMA = 20  # righe del risultato mostrate nella tabella, il resto è disponibile nel file allegato
+# Esecuzioni contemporanee dell'agente e della validazione tra tutte le sessioni, da regolare in base ai limiti
+# di richieste dell'API Groq e al carico sostenibile dal database
+AGENT_MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENT_AGENTS", "8"))
+
+agent_semaphore = asyncio.Semaphore(AGENT_MAX_CONCURRENCY)
+
+logger = logging.getLogger(__name__)
+
+# Introduzione all'assistente e descrizione del database
+INTRO_MESSAGE = (
+    "👋 Ciao! Sono il tuo assistente intelligente, qui per aiutarti a esplorare e interrogare il database"
+    " degli acquisti basati sugli scontrini che sono stati caricati. Posso rispondere alle tue domande,"
+    " filtrare informazioni rilevanti e generare riepiloghi personalizzati sulle spese e sulle abitudini di"
+    " consumo.\n\n 📄 Il database contiene informazioni estratte dalle immagini degli scontrini, come i dettagli"
+    " dei negozi, le transazioni, i prodotti acquistati ed eventuali sconti applicati. È pensato per offrirti"
+    " risposte su tutto ciò che riguarda acquisti, prezzi, negozi, date, metodi di pagamento e frequenza"
+    " di spesa.\n\n 🗨️ Scrivimi una domanda oppure seleziona uno degli esempi qui sotto: sono pronto ad"
+    " aiutarti! 😊"
+)
+
+# Esempi di domande come pulsanti cliccabili e icone, nell'ordine in cui vengono mostrati
+EXAMPLE_QUESTIONS = (
+    ("Mostrami i primi 15 scontrini caricati nel 2025", "receipt-euro"),
+    ("Mostrami i primi 10 acquisti effettuati nel 2025", "shopping-cart"),
+    ("Elenca i prodotti per cui è stato applicato uno sconto", "percent"),
+    ("Qual è la somma totale delle spese effettuate nel mese di marzo?", "calendar-days"),
+    ("Quali prodotti sono stati acquistati più di una volta in giorni diversi?", "repeat"),
+    ("In quale mese del 2025 ho speso di più in totale?", "calendar-clock"),
+    ("Quali negozi ho visitato più spesso?", "map-pin"),
+    ("Qual è stato il metodo di pagamento più usato nei miei acquisti?", "credit-card"),
+    ("Mostrami tutti i prodotti acquistati in contanti", "wallet"),
+    ("Quali sono i prodotti più acquistati in termini di quantità totale?", "chart-bar")
+)
+
+
+@lru_cache(maxsize=1)
+def get_llm_key():
+    """
+    Funzione che restituisce la chiave API per il modello AI
+    - Usa get_secret, che legge la variabile d'ambiente GROQ_LLM_KEY o il file dei secrets di Streamlit
+      senza importare Streamlit
+    - La chiave viene letta alla prima richiesta e non durante l'import del modulo
+    :return: chiave API del provider Groq
+    """
+    return get_secret("general", "GROQ_LLM_KEY")
+
 
-# Chiave API
-llm_key = st.secrets["general"]["GROQ_LLM_KEY"]
+@lru_cache(maxsize=1)
+def get_agent():
+    """
+    Funzione che restituisce l'agente LangChain condiviso da tutte le sessioni della chat
+    - L'agente viene costruito alla prima richiesta e poi riutilizzato: non ha memoria della
+      conversazione, quindi modello, tool e schema del database possono essere condivisi
+    :return: agente LangChain, modello llm, schema del database
+    """
+    return build_custom_agent(get_llm_key())
 
 
 @cl.action_callback("esempio_domanda")
@@ -37,54 +110,25 @@ async def question_action_handler(action: cl.Action):
 async def on_chat_start():
     """
     Funzione di avvio della chat Chainlit
-    - Inizializza l’agente LangChain e memorizza il modello, l'agente e lo schema del database
-    - Mostra un messaggio introduttivo con descrizione del database
+    - Recupera l’agente LangChain condiviso e memorizza nella sessione il modello, l'agente e lo schema del database
+    - Mostra il messaggio introduttivo con descrizione del database, definito una sola volta a livello di modulo
     - Invia una serie di esempi interattivi di domande come pulsanti con icone e tooltip
     """
-    # Inizializza agente e componenti
-    agent, llm, db_schema = build_custom_agent(llm_key)
+    # Recupera agente e componenti, costruiti una sola volta per processo
+    agent, llm, db_schema = get_agent()
     cl.user_session.set("agent", agent)
     cl.user_session.set("llm", llm)
     cl.user_session.set("db_schema", db_schema)
 
-    # Introduzione all'assistente e descrizione del database
-    intro = (
-        "👋 Ciao! Sono il tuo assistente intelligente, qui per aiutarti a esplorare e interrogare il database"
-        " degli acquisti basati sugli scontrini che sono stati caricati. Posso rispondere alle tue domande,"
-        " filtrare informazioni rilevanti e generare riepiloghi personalizzati sulle spese e sulle abitudini di"
-        " consumo.\n\n 📄 Il database contiene informazioni estratte dalle immagini degli scontrini, come i dettagli"
-        " dei negozi, le transazioni, i prodotti acquistati ed eventuali sconti applicati. È pensato per offrirti"
-        " risposte su tutto ciò che riguarda acquisti, prezzi, negozi, date, metodi di pagamento e frequenza"
-        " di spesa.\n\n 🗨️ Scrivimi una domanda oppure seleziona uno degli esempi qui sotto: sono pronto ad"
-        " aiutarti! 😊"
-    )
-    await cl.Message(content=intro).send()
-
-    # Esempi di domande come pulsanti cliccabili e icone
-    examples = {
-        "Mostrami i primi 15 scontrini caricati nel 2025": "receipt-euro",
-        "Mostrami i primi 10 acquisti effettuati nel 2025": "shopping-cart",
-        "Elenca i prodotti per cui è stato applicato uno sconto": "percent",
-        "Qual è la somma totale delle spese effettuate nel mese di marzo?": "calendar-days",
-        "Quali prodotti sono stati acquistati più di una volta in giorni diversi?": "repeat",
-        "In quale mese del 2025 ho speso di più in totale?": "calendar-clock",
-        "Quali negozi ho visitato più spesso?": "map-pin",
-        "Qual è stato il metodo di pagamento più usato nei miei acquisti?": "credit-card",
-        "Mostrami tutti i prodotti acquistati in contanti": "wallet",
-        "Quali sono i prodotti più acquistati in termini di quantità totale?": "chart-bar"
-    }
-
-    # Invio degli esempi come azioni interattive (pulsanti)
-    actions = []
-    for question, icon in examples.items():
-        action = cl.Action(
-            name="esempio_domanda",
-            payload={"value": question},
-            label=question,
-            icon=icon,
-            tooltip="Domanda di esempio"
-        )
-        actions.append(action)
+    await cl.Message(content=INTRO_MESSAGE).send()
+
+    # Invio degli esempi come azioni interattive (pulsanti); le azioni vengono create per ogni sessione
+    # perché Chainlit, all'invio, le associa al messaggio che le contiene
+    actions = [
+        cl.Action(name="esempio_domanda", payload={"value": question}, label=question, icon=icon,
+                  tooltip="Domanda di esempio")
+        for question, icon in EXAMPLE_QUESTIONS
+    ]
 
     await cl.Message(
         content="Ecco alcuni esempi di domande che puoi fare:",
@@ -92,25 +136,216 @@ async def on_chat_start():
     ).send()
 
 
+def normalize_message(text):
+    """
+    Funzione che normalizza il testo inviato dall'utente
+    - Applica la normalizzazione Unicode NFKC, così che caratteri equivalenti (ad esempio lettere
+      accentate composte o scomposte) abbiano sempre la stessa rappresentazione
+    - Rimuove gli spazi iniziali e finali e compatta quelli interni
+    - Il testo normalizzato è usato per risposte rapide, cache, validazione e agente, così che la stessa
+      domanda produca sempre lo stesso prompt
+    :param text: testo del messaggio dell'utente
+    :return: testo normalizzato
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def parse_raw_result(output):
+    """
+    Funzione che converte il risultato grezzo restituito dal tool QueryExecutor in una lista di righe
+    - Il tool restituisce le righe in formato JSON, quindi prova prima a leggerle con orjson
+    - In caso di errore prova a interpretare il testo come letterale Python (formato di db.run)
+    - Se nessuna delle due conversioni riesce (ad esempio per un messaggio di errore), restituisce il testo
+    :param output: risultato del tool QueryExecutor
+    :return: lista di righe del risultato, oppure il testo originale se non convertibile
+    """
+    if not isinstance(output, str):
+        return output
+    try:
+        return orjson.loads(output)
+    except orjson.JSONDecodeError:
+        try:
+            return ast.literal_eval(output)
+        except (ValueError, SyntaxError):
+            return output
+
+
+def format_rows(rows, columns=None, limit=RIGHE_ANTEPRIMA):
+    """
+    Funzione che converte il risultato di una query in una tabella Markdown
+    - Usa i nomi delle colonne se disponibili, altrimenti intestazioni numerate
+    - Mostra al massimo limit righe e indica quante righe sono state omesse
+    - Costruisce il testo con StringIO, senza concatenare ripetutamente stringhe
+    :param rows: lista di righe del risultato
+    :param columns: nomi delle colonne del risultato
+    :param limit: numero massimo di righe da mostrare
+    :return: stringa con la tabella Markdown
+    """
+    def format_cells(values):
+        return " | ".join(str(value).replace("|", "\\|").replace("\n", " ") for value in values)
+
+    preview = [row if isinstance(row, (list, tuple)) else [row] for row in islice(rows, limit)]
+    header = columns or [f"Colonna {i}" for i in range(1, len(preview[0]) + 1)]
+
+    table = io.StringIO()
+    table.write(f"| {format_cells(header)} |\n")
+    table.write("|" + " --- |" * len(header) + "\n")
+    for row in preview:
+        table.write(f"| {format_cells(row)} |\n")
+    if len(rows) > limit:
+        table.write(f"\n… *altre {len(rows) - limit} righe omesse, il risultato completo è nel file allegato*")
+
+    return table.getvalue()
+
+
+def build_result_messages(question, sql_query, raw_result, columns=None):
+    """
+    Funzione che prepara i messaggi che precedono la risposta finale a una domanda
+    - Se il risultato ha esattamente MAX_RIGHE righe, aggiunge un avviso di limitazione
+    - Aggiunge messaggi distinti per domanda, query e risultato grezzo, nell'ordine in cui devono comparire
+    - Mostra il risultato grezzo come tabella con le prime RIGHE_ANTEPRIMA righe, allegando il risultato
+      completo come file JSON
+    :param question: domanda dell'utente
+    :param sql_query: query SQL generata dall'agente
+    :param raw_result: risultato grezzo della query
+    :param columns: nomi delle colonne del risultato, se disponibili
+    :return: lista di oggetti cl.Message ancora da inviare
+    """
+    messages = []
+    # Il risultato può essere anche il testo di un errore, che non va trattato come lista di righe
+    result_rows = raw_result if isinstance(raw_result, list) else None
+
+    # Avviso se il risultato supera il limite
+    if result_rows is not None and len(result_rows) == MAX_RIGHE:
+        messages.append(cl.Message(
+            content=f"⚠️ La risposta è stata limitata ai primi {MAX_RIGHE} elementi per garantire una maggiore"
+                    f" velocità e stabilità"
+        ))
+
+    # Messaggi separati
+    messages.append(cl.Message(content=f"**Domanda:**\n{question}"))
+
+    if sql_query:
+        messages.append(cl.Message(content=f"**Query generata:**\n```sql\n{sql_query}\n```"))
+
+    if result_rows:
+        # Tabella con le prime righe e risultato completo come file JSON allegato
+        full_result = cl.File(
+            name="risultato.json",
+            content=orjson.dumps({"columns": columns, "rows": result_rows}, default=str,
+                                 option=orjson.OPT_INDENT_2),
+            mime="application/json",
+            display="inline"
+        )
+        messages.append(cl.Message(content=f"**Risultato grezzo:**\n{format_rows(result_rows, columns)}",
+                                   elements=[full_result]))
+    elif raw_result:
+        messages.append(cl.Message(content=f"**Risultato grezzo:**\n{raw_result}"))
+
+    return messages
+
+
+async def send_answer(question, sql_query, raw_result, final_answer, columns=None):
+    """
+    Funzione che mostra all'utente la risposta completa a una domanda
+    - Prepara i messaggi con build_result_messages e aggiunge quello con la risposta finale
+    - Invia i messaggi uno alla volta, nell'ordine in cui devono comparire
+    :param question: domanda dell'utente
+    :param sql_query: query SQL generata dall'agente
+    :param raw_result: risultato grezzo della query
+    :param final_answer: risposta finale dell'agente
+    :param columns: nomi delle colonne del risultato, se disponibili
+    """
+    messages = build_result_messages(question, sql_query, raw_result, columns)
+    messages.append(cl.Message(content=f"**Risposta finale:**\n{final_answer}"))
+
+    # Invio in sequenza: il messaggio con il file allegato attende il caricamento del file prima di comparire,
+    # quindi inviando i messaggi contemporaneamente i successivi potrebbero comparire prima di lui
+    for msg in messages:
+        await msg.send()
+
+
+async def stream_agent_answer(agent, question):
+    """
+    Funzione che esegue l’agente LangChain su una domanda mostrando la risposta finale in streaming
+    - Esegue l'agente con astream_events: query e risultato vengono letti alla fine dei rispettivi tool
+      (l'ultima esecuzione sostituisce le precedenti) e i token della risposta finale vengono mostrati
+      mentre il modello li genera
+    - Al primo token invia i messaggi di build_result_messages, così che precedano la risposta
+    - Se nessun token è stato mostrato (ad esempio per un risultato vuoto), invia la risposta intera con send_answer
+    :param agent: agente LangChain
+    :param question: domanda normalizzata dell'utente
+    :return: query SQL, risultato grezzo, nomi delle colonne e risposta finale
+    """
+    # Lista in cui il tool QueryExecutor salva le righe ottenute; i tool sincroni vengono eseguiti in
+    # un thread che riceve una copia del contesto, quindi condividono la stessa lista
+    collected_results = []
+    query_results.set(collected_results)
+
+    answer_message = cl.Message(content="**Risposta finale:**\n")
+    answer_streamed = False
+    sql_query = None
+    raw_result = None
+    columns = None
+    final_answer = None
+
+    async for event in agent.astream_events({"input": question}, version="v2"):
+        kind = event["event"]
+        if kind == "on_tool_end" and event["name"] == "SQLQueryGenerator":
+            sql_query = event["data"]["output"]
+        elif kind == "on_tool_end" and event["name"] == "QueryExecutor":
+            # Usa le righe originali dell'ultima esecuzione, se disponibili, invece di rileggere il testo
+            if collected_results and collected_results[-1] is not None:
+                columns = collected_results[-1]["columns"]
+                raw_result = collected_results[-1]["rows"]
+            else:
+                columns = None
+                raw_result = parse_raw_result(event["data"]["output"])
+        elif kind == "on_chat_model_stream" and FINAL_ANSWER_TAG in event["tags"]:
+            token = event["data"]["chunk"].content
+            if not token:
+                continue
+            if not answer_streamed:
+                # Al primo token mostra domanda, query e risultato, così che precedano la risposta
+                result_messages = build_result_messages(question, sql_query, raw_result, columns)
+                for msg in result_messages:
+                    await msg.send()
+                answer_streamed = True
+            await answer_message.stream_token(token)
+        elif kind == "on_chain_end" and not event["parent_ids"]:
+            final_answer = event["data"]["output"]["output"]
+
+    if answer_streamed:
+        await answer_message.update()
+    else:
+        await send_answer(question, sql_query, raw_result, final_answer, columns)
+
+    return sql_query, raw_result, columns, final_answer
+
+
 @cl.on_message
 async def on_message(message: cl.Message):
     """
     Funzione che gestisce ogni nuovo messaggio dell’utente
-    - Filtra messaggi di cortesia o saluto per risposte rapide
+    - Normalizza il testo una sola volta e lo usa in tutti i passaggi successivi
+    - Filtra messaggi di cortesia o saluto per risposte rapide, senza considerare la punteggiatura finale
+    - Se una domanda uguale o simile ha già una risposta in cache, la mostra senza eseguire l'agente
+      (sopra SEMANTIC_CACHE_SERVE_THRESHOLD direttamente, altrimenti dopo la conferma del modello)
     - Valida la domanda rispetto allo schema del database
-    - Invoca l’agente LangChain e recupera la query, il risultato SQL e la risposta finale
-    - Mostra messaggi distinti per query, risultato grezzo e risposta finale
-    - Se il risultato ha esattamente MAX_RIGHE righe, mostra un avviso di limitazione
+    - Limita a AGENT_MAX_CONCURRENCY le chiamate contemporanee al modello (conferma della cache, validazione
+      ed esecuzioni dell'agente) tra tutte le sessioni
+    - Esegue l’agente con stream_agent_answer; i rate limit sono gestiti dai tentativi del client del modello
+    - Memorizza la risposta nella cache solo se la query è stata eseguita e c'è una risposta finale
+    - Distingue gli errori di rate limit e del database, per cui mostra un messaggio dedicato, dagli altri
+      errori, che vengono registrati nel log con il traceback completo
     :param message: oggetto cl.Message contenente il testo dell’utente
     """
-    content = message.content.lower().strip()
+    question = normalize_message(message.content)
 
-    if content in GREETING_MESSAGES:
-        await cl.Message(content="Ciao! Chiedimi pure, sono qui per aiutarti.").send()
-        return
-
-    if content in COURTESY_MESSAGES:
-        await cl.Message(content="Prego! Fammi sapere se hai altre domande.").send()
+    # Ignora la punteggiatura finale, così che ad esempio "ciao!" o "grazie." ricevano la risposta rapida
+    fast_reply = FAST_REPLIES.get(question.lower().rstrip("!.?¿¡ "))
+    if fast_reply:
+        await cl.Message(content=fast_reply).send()
         return
 
     # Recupera oggetti sessione
@@ -118,49 +353,50 @@ async def on_message(message: cl.Message):
     llm = cl.user_session.get("llm")
     db_schema = cl.user_session.get("db_schema")
 
-    # Validazione semantica della domanda
-    if not is_question_valid_for_db(message.content, llm, db_schema):
-        await cl.Message(content="La domanda non è compatibile con le informazioni presenti nel database."
-                                 " Prova a formularne una diversa, più adatta").send()
-        return
-
-    # Messaggio di attesa
-    thinking = cl.Message(content="Sto elaborando la risposta, un attimo di pazienza...")
-    await thinking.send()
-
     try:
-        # Esecuzione dell'agente
-        response = agent.invoke({"input": message.content})
-        final_answer = response["output"]
-
-        sql_query = None
-        raw_result = None
-
-        for action, output in response["intermediate_steps"]:
-            if action.tool == "SQLQueryGenerator":
-                sql_query = output
-            elif action.tool == "QueryExecutor":
-                raw_result = output
-                if isinstance(raw_result, str):
-                    raw_result = ast.literal_eval(raw_result)
-
-        # Avviso se il risultato supera il limite
-        if raw_result and isinstance(raw_result, list) and len(raw_result) == MAX_RIGHE:
-            await cl.Message(
-                content=f"⚠️ La risposta è stata limitata ai primi {MAX_RIGHE} elementi per garantire una maggiore"
-                        f" velocità e stabilità"
-            ).send()
+        # Se una domanda uguale o molto simile ha già una risposta, la riutilizza senza eseguire l'agente;
+        # per le domande solo abbastanza simili chiede prima conferma al modello
+        cached_entry, similarity = find_similar_question(question)
+        if cached_entry:
+            is_equivalent = similarity >= SEMANTIC_CACHE_SERVE_THRESHOLD
+            if not is_equivalent:
+                # La conferma è una chiamata al modello: viene eseguita in un thread separato e conta nel
+                # limite di chiamate contemporanee come le altre
+                async with agent_semaphore:
+                    is_equivalent = await asyncio.to_thread(are_questions_equivalent, question,
+                                                            cached_entry["original_question"], llm)
+            if is_equivalent:
+                await send_answer(question, cached_entry["sql_query"], cached_entry["raw_result"],
+                                  cached_entry["final_answer"], cached_entry["columns"])
+                return
 
-        # Messaggi separati
-        await cl.Message(content=f"**Domanda:**\n{message.content}").send()
+        # Validazione semantica della domanda, eseguita in un thread separato per non bloccare le altre sessioni
+        async with agent_semaphore:
+            is_valid = await asyncio.to_thread(is_question_valid_for_db, question, llm, db_schema)
 
-        if sql_query:
-            await cl.Message(content=f"**Query generata:**\n```sql\n{sql_query}\n```").send()
+        if not is_valid:
+            await cl.Message(content="La domanda non è compatibile con le informazioni presenti nel database."
+                                     " Prova a formularne una diversa, più adatta").send()
+            return
 
-        if raw_result:
-            await cl.Message(content=f"**Risultato grezzo:**\n{raw_result}").send()
+        # I rate limit delle singole chiamate al modello sono già ripetuti con attesa esponenziale dal client
+        # (max_retries in build_custom_agent): rieseguire l'intero agente invierebbe di nuovo i messaggi già
+        # mostrati e ripeterebbe la query
+        async with agent_semaphore:
+            sql_query, raw_result, columns, final_answer = await stream_agent_answer(agent, question)
 
-        await cl.Message(content=f"**Risposta finale:**\n{final_answer}").send()
+        # Memorizza solo le risposte riuscite: un errore della query o una risposta mancante (ad esempio per il
+        # limite di iterazioni dell'agente) verrebbe altrimenti riproposto finché il database non cambia
+        if isinstance(raw_result, list) and final_answer:
+            add_to_semantic_cache(question, sql_query, raw_result, final_answer, columns)
 
-    except Exception as e:
-        await cl.Message(content=f"Errore: {str(e)}").send()
+    except RateLimitError:
+        # Il client ha già esaurito i suoi tentativi: l'utente viene invitato ad attendere prima di riprovare
+        await cl.Message(content="Il servizio AI è momentaneamente sovraccarico. Attendi qualche secondo e"
+                                 " riprova").send()
+    except (SQLAlchemyError, sqlite3.Error):
+        logger.exception("Errore del database durante la risposta alla domanda: %s", question)
+        await cl.Message(content="Errore del database, riprova").send()
+    except Exception:
+        logger.exception("Errore durante la risposta alla domanda: %s", question)
+        await cl.Message(content="Errore interno, riprova più tardi").send()